@@ -1,30 +1,130 @@
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+
+import constants
+import evidencestore
+import jsonstream
+import metrics
+import ratelimit
+import resilience
+import responsecache
+import singleflight
+import traffic
 
 
 infermedica_url = 'https://api.infermedica.com/v3/{}'
 
+# Shared transport. All the endpoints are served by the same host, so a single
+# pooled session lets consecutive calls reuse kept-alive connections instead of
+# doing a new TCP+TLS handshake each time.
+_session = None
+_session_lock = threading.Lock()
+_pool_size = constants.HTTP_POOL_SIZE
+_timeout = (constants.HTTP_CONNECT_TIMEOUT, constants.HTTP_READ_TIMEOUT)
 
-def _remote_headers(auth_string, case_id, language_model=None):
+# Fields of the responses actually used (see jsonstream.project).
+DIAGNOSIS_FIELDS = {'question': None,
+                    'conditions': ('id', 'name', 'common_name', 'probability'),
+                    'should_stop': None}
+NAMING_FIELDS = ('id', 'name', 'common_name')
+
+# Set to a responsecache.ResponseCache to answer repeated /parse requests
+# locally (see configure_parse_cache).
+parse_cache = None
+# Likewise for /diagnosis and /triage (see configure_interview_cache).
+interview_cache = None
+
+# Set to a traffic.TrafficRecorder to log all the calls, or to a
+# traffic.TrafficReplayer to answer them from such logs instead of the network
+# (see record_traffic and replay_traffic).
+recorder = None
+replayer = None
+
+# Resilience policy (see resilience.py): set retry_policy to None to make
+# single attempts only, hedge_quantile to e.g. 0.95 to send a second request
+# when a call takes longer than that latency percentile of its endpoint.
+retry_policy = resilience.RetryPolicy()
+hedge_quantile = None
+_breakers = {}  # endpoint -> resilience.CircuitBreaker
+_breakers_lock = threading.Lock()
+
+# Identical requests made at the same time are sent once, the callers share
+# the response (see singleflight.py); set coalesce_requests to False to send
+# each of them.
+coalesce_requests = True
+flights = singleflight.Group('api')
+
+
+def configure_transport(pool_size=None, connect_timeout=None,
+                        read_timeout=None, base_url=None):
+    """Change the settings of the shared HTTP transport. Pool size is the
+    maximum number of kept-alive connections (it should match the number of
+    threads calling the API concurrently). Timeouts are in seconds and serve as
+    defaults for calls that don't specify their own. Base URL replaces the
+    Infermedica API one (e.g. to use a local mock server). The current session
+    is closed, the next call will open a new one with the new settings."""
+    global _session, _pool_size, _timeout, infermedica_url
+    with _session_lock:
+        if pool_size is not None:
+            _pool_size = pool_size
+        connect, read = _timeout
+        _timeout = (connect if connect_timeout is None else connect_timeout,
+                    read if read_timeout is None else read_timeout)
+        if base_url is not None:
+            infermedica_url = base_url.rstrip('/') + '/{}'
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _forget_session():
+    # A forked process must not use the connections of its parent.
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_session)
+
+
+def get_session():
+    """Return the shared pooled session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=_pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+@functools.lru_cache(maxsize=64)
+def _base_headers(auth_string, language_model=None):
+    """Headers common to all the calls made with the given credentials and
+    model. Cached, so don't modify the returned dict."""
     app_id, app_key = auth_string.split(':')
     headers = {
         'Content-Type': 'application/json',
         'Dev-Mode': 'true',  # please turn this off when your app goes live
-        'Interview-Id': case_id,
         'App-Id': app_id,
         'App-Key': app_key}
     if language_model:
         headers['Model'] = language_model
-    return headers
-
-
-def call_endpoint(endpoint, auth_string, params, request_spec, case_id,
-                  language_model=None):
-    if auth_string and ':' in auth_string:
-        url = infermedica_url.format(endpoint)
-        headers = _remote_headers(auth_string, case_id, language_model)
-    else:
-        raise IOError('need App-Id:App-Key auth string')
-    if language_model:
         # name of a model that designates a language and possibly a
         # non-standard knowledge base e.g. infermedica-es
         # (the default model is infermedica-en)
@@ -34,19 +134,352 @@ def call_endpoint(endpoint, auth_string, params, request_spec, case_id,
         else:
             lang_code = language_model
         headers['Language'] = lang_code
+    return headers
+
+
+def _remote_headers(auth_string, case_id, language_model=None):
+    headers = dict(_base_headers(auth_string, language_model))
+    headers['Interview-Id'] = case_id
+    return headers
+
+
+def _send(endpoint, auth_string, params, request_spec, case_id,
+          language_model=None, timeout=None, stream=False):
+    """Make the HTTP call and return the (successful) response object."""
+    if auth_string and ':' in auth_string:
+        url = infermedica_url.format(endpoint)
+        headers = _remote_headers(auth_string, case_id, language_model)
+    else:
+        raise IOError('need App-Id:App-Key auth string')
+    if timeout is None:
+        timeout = _timeout
+    session = get_session()
     if request_spec:
-        resp = requests.post(
+        headers['Content-Type'] = 'application/json'
+        resp = session.post(
             url,
             params=params,
-            json=request_spec,
-            headers=headers)
+            data=_encode_request(request_spec),
+            headers=headers,
+            timeout=timeout,
+            stream=stream)
     else:
-        resp = requests.get(
+        resp = session.get(
             url,
             params=params,
-            headers=headers)
-    resp.raise_for_status()
-    return resp.json()
+            headers=headers,
+            timeout=timeout,
+            stream=stream)
+    try:
+        resp.raise_for_status()
+    except requests.HTTPError:
+        resp.close()
+        raise
+    return resp
+
+
+def _encode_request(request_spec):
+    """Return the JSON body of the request. Evidence kept in an
+    evidencestore.EvidenceStore is joined from its pre-encoded pieces."""
+    evidence = request_spec.get('evidence')
+    if not isinstance(evidence, evidencestore.EvidenceStore):
+        return json.dumps(request_spec).encode('utf-8')
+    rest = json.dumps({field: value for field, value in request_spec.items()
+                       if field != 'evidence'})
+    body = '{"evidence": ' + evidence.to_json()
+    body += ', ' + rest[1:] if rest != '{}' else '}'
+    return body.encode('utf-8')
+
+
+def _plain_request(request_spec):
+    """Return the request with evidence as a list of dicts."""
+    evidence = (request_spec or {}).get('evidence')
+    if not isinstance(evidence, evidencestore.EvidenceStore):
+        return request_spec
+    return dict(request_spec, evidence=[dict(piece) for piece in evidence])
+
+
+def record_traffic(path, **kwargs):
+    """Start logging all the calls to the given file (see
+    traffic.TrafficRecorder for the options)."""
+    global recorder
+    stop_recording()
+    recorder = traffic.TrafficRecorder(path, **kwargs)
+    return recorder
+
+
+def stop_recording():
+    global recorder
+    if recorder is not None:
+        recorder.close()
+        recorder = None
+
+
+def replay_traffic(*paths):
+    """Answer all the calls from the given traffic logs instead of the
+    network; pass no paths to go back to the network."""
+    global replayer
+    replayer = traffic.TrafficReplayer(paths) if paths else None
+    return replayer
+
+
+def _breaker(endpoint):
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(endpoint,
+                                           resilience.CircuitBreaker())
+    return breaker
+
+
+def _hedge_delay(labels):
+    """Latency percentile of the endpoint after which a call gets hedged, or
+    None (hedging off or too few calls observed yet)."""
+    if hedge_quantile is None:
+        return None
+    histogram = metrics.registry.histogram('call_seconds', labels)
+    if histogram is None or histogram.count < constants.HEDGE_MIN_SAMPLES:
+        return None
+    delay = histogram.quantile(hedge_quantile)
+    # beyond the last bucket the quantile is unknown (inf)
+    return delay if math.isfinite(delay) else None
+
+
+def _throttle(endpoint, auth_string, case_id, priority):
+    """Wait for the rate limiter (see ratelimit.configure), if any."""
+    app_id = (auth_string or '').split(':')[0]
+    scheduler = ratelimit.get_scheduler(app_id)
+    if scheduler is not None:
+        scheduler.acquire(endpoint, case_id, priority)
+
+
+def _labels(endpoint, language_model):
+    return (('endpoint', endpoint), ('model', language_model or ''))
+
+
+def _record_failure(breaker, error):
+    if resilience.is_transient(error):
+        breaker.record_failure()
+    else:
+        breaker.record_success()  # the endpoint itself works
+
+
+def _retry_delay(endpoint, labels, error, attempt_no):
+    """Seconds to wait before retrying the call that failed on the given
+    attempt, or None if it's not to be retried (see retry_policy)."""
+    if retry_policy is None:
+        return None
+    delay = retry_policy.delay(endpoint, error, attempt_no)
+    if delay is not None:
+        metrics.registry.count('retries_total', labels)
+    return delay
+
+
+def _resilient(endpoint, language_model, attempt):
+    """Make the call by running attempt() under the resilience policy:
+    circuit breaker, retries and hedging (see resilience.py)."""
+    breaker = _breaker(endpoint)
+    labels = _labels(endpoint, language_model)
+    attempt_no = 1
+    while True:
+        with breaker.calling(endpoint):
+            try:
+                hedge_delay = _hedge_delay(labels)
+                if hedge_delay is None:
+                    result = attempt()
+                else:
+                    result, hedged = resilience.hedged_call(attempt,
+                                                            hedge_delay)
+                    if hedged:
+                        metrics.registry.count('hedges_total', labels)
+            except (IOError, ValueError) as e:
+                _record_failure(breaker, e)
+                error = e
+            else:
+                breaker.record_success()
+                return result
+        delay = _retry_delay(endpoint, labels, error, attempt_no)
+        if delay is None:
+            raise error
+        time.sleep(delay)
+        attempt_no += 1
+
+
+def call_endpoint(endpoint, auth_string, params, request_spec, case_id,
+                  language_model=None, timeout=None,
+                  priority=ratelimit.INTERACTIVE, projection=None):
+    """Call the given endpoint over the shared session. Use timeout (seconds,
+    or a (connect, read) tuple) to override the default one for this call.
+    Transient failures are retried (see retry_policy). Each attempt waits
+    for the rate limiter in the given priority class, if rate limiting is
+    on, and is reported to metrics (and logged if recording traffic).
+
+    Give projection to keep only some fields of the response (see
+    jsonstream.project); large responses are then decoded as they're being
+    downloaded, without ever building the whole document."""
+    if replayer is not None:
+        return jsonstream.project(replayer.response(
+            endpoint, params, _plain_request(request_spec)), projection)
+    call = functools.partial(
+        _resilient, endpoint, language_model, functools.partial(
+            _call_once, endpoint, auth_string, params, request_spec, case_id,
+            language_model, timeout, priority, projection))
+    key = flight_key(endpoint, auth_string, params, request_spec,
+                     language_model, projection)
+    if key is None:
+        return call()
+    return flights.do(key, call)
+
+
+def flight_key(endpoint, auth_string, params, request_spec,
+               language_model=None, projection=None):
+    """Return the key under which identical concurrent calls are coalesced
+    (see coalesce_requests), or None if the call must be made anyway. The
+    body is hashed in canonical form: keys sorted, evidence by its digest."""
+    if (not coalesce_requests
+            or endpoint not in resilience.IDEMPOTENT_ENDPOINTS):
+        return None
+    body = dict(request_spec or {})
+    if 'evidence' in body:
+        body['evidence'] = evidencestore.digest(body['evidence'])
+    body_hash = hashlib.blake2b(
+        json.dumps(body, sort_keys=True, separators=(',', ':')).encode(
+            'utf-8'), digest_size=16).hexdigest()
+    return (endpoint, (auth_string or '').split(':')[0], language_model,
+            tuple(sorted((params or {}).items())), body_hash,
+            repr(projection))
+
+
+def _decode(resp, projection):
+    """Decode the JSON body of the streamed response. Return the content
+    and the size of the body."""
+    length = resp.headers.get('Content-Length')
+    if (projection is None or recorder is not None or (
+            length is not None
+            and int(length) <= constants.JSON_STREAM_THRESHOLD)):
+        # small enough to be decoded in one go by the fastest backend
+        content = jsonstream.project(jsonstream.loads(resp.content),
+                                     projection)
+        return content, len(resp.content)
+    size = 0
+
+    def counted_chunks():
+        nonlocal size
+        for chunk in resp.iter_content(
+                chunk_size=constants.HTTP_STREAM_CHUNK_SIZE):
+            size += len(chunk)
+            yield chunk
+    return jsonstream.decode_chunks(counted_chunks(), projection), size
+
+
+def _call_once(endpoint, auth_string, params, request_spec, case_id,
+               language_model, timeout, priority, projection):
+    _throttle(endpoint, auth_string, case_id, priority)
+    return _attempt(endpoint, auth_string, params, request_spec, case_id,
+                    language_model, timeout, projection)
+
+
+def _attempt(endpoint, auth_string, params, request_spec, case_id,
+             language_model, timeout, projection):
+    """Make one HTTP attempt of the call (rate limiter already passed)."""
+    call = {'case_id': case_id, 'endpoint': endpoint,
+            'language_model': language_model, 'started': time.time(),
+            'status': None, 'error': None}
+    started = time.perf_counter()
+    try:
+        resp = _send(endpoint, auth_string, params, request_spec, case_id,
+                     language_model, timeout, stream=True)
+        received = time.perf_counter()
+        with contextlib.closing(resp):
+            content, response_bytes = _decode(resp, projection)
+    except (IOError, ValueError) as e:
+        call['seconds'] = time.perf_counter() - started
+        call['error'] = type(e).__name__
+        response = getattr(e, 'response', None)
+        if response is not None:
+            call['status'] = response.status_code
+        metrics.record_call(call)
+        raise
+    decoded = time.perf_counter()
+    call.update(
+        seconds=decoded - started,
+        status=resp.status_code,
+        server_seconds=resp.elapsed.total_seconds(),
+        decode_seconds=decoded - received,
+        request_bytes=len(resp.request.body or b''),
+        response_bytes=response_bytes)
+    metrics.record_call(call)
+    if recorder is not None:
+        recorder.record(
+            endpoint, resp.request.method, params, resp.request.body,
+            resp.request.headers, resp.status_code, resp.content,
+            {'total_ms': round(call['seconds'] * 1000, 3),
+             'server_ms': round(call['server_seconds'] * 1000, 3),
+             'transfer_ms': round((received - started) * 1000, 3),
+             'decode_ms': round(call['decode_seconds'] * 1000, 3),
+             'request_bytes': call['request_bytes'],
+             'response_bytes': call['response_bytes']})
+    return content
+
+
+def configure_parse_cache(path=None, max_size=constants.PARSE_CACHE_SIZE,
+                          ttl=constants.PARSE_CACHE_TTL):
+    """Turn on caching of /parse responses. By default the cache is kept in
+    memory; give path of an SQLite file to share it with other processes."""
+    global parse_cache
+    if path:
+        backend = responsecache.SqliteBackend(path, max_size, table='parse')
+    else:
+        backend = responsecache.MemoryBackend(max_size)
+    parse_cache = responsecache.ResponseCache(backend, ttl, name='parse')
+    return parse_cache
+
+
+def configure_interview_cache(path=None,
+                              max_size=constants.INTERVIEW_CACHE_SIZE,
+                              ttl=constants.INTERVIEW_CACHE_TTL):
+    """Turn on memoization of /diagnosis and /triage responses. By default the
+    cache is kept in memory (see ResponseCache.save and load for persisting
+    the most used entries); give path of an SQLite file to keep it there."""
+    global interview_cache
+    if path:
+        backend = responsecache.SqliteBackend(path, max_size,
+                                              table='interview')
+    else:
+        backend = responsecache.MemoryBackend(max_size)
+    interview_cache = responsecache.ResponseCache(backend, ttl,
+                                                 name='interview')
+    return interview_cache
+
+
+def _interview_key(endpoint, request_spec, language_model, *key_parts):
+    return responsecache.make_key(
+        endpoint, evidencestore.digest(request_spec['evidence']),
+        request_spec['age'], request_spec['sex'], language_model, *key_parts)
+
+
+def _call_interview_endpoint(endpoint, request_spec, case_id, auth_string,
+                             language_model, projection, *key_parts):
+    if interview_cache is None:
+        return call_endpoint(endpoint, auth_string, None, request_spec,
+                             case_id, language_model, projection=projection)
+    key = _interview_key(endpoint, request_spec, language_model, *key_parts)
+    return interview_cache.get_or_call(
+        key, lambda: call_endpoint(endpoint, auth_string, None, request_spec,
+                                   case_id, language_model,
+                                   projection=projection))
+
+
+def _diagnosis_request(evidence, age, sex, no_groups):
+    return {
+        'age': age,
+        'sex': sex,
+        'evidence': evidence,
+        'extras': {
+            # voice/chat apps usually can't handle group questions well
+            'disable_groups': no_groups
+        }
+    }
 
 
 def call_diagnosis(evidence, age, sex, case_id, auth_string, no_groups=True,
@@ -64,17 +497,10 @@ def call_diagnosis(evidence, age, sex, case_id, auth_string, no_groups=True,
     questions and multiple questions gathered together under one subtitle; it's
     hard to handle such questions in voice-only chatbot).
     """
-    request_spec = {
-        'age': age,
-        'sex': sex,
-        'evidence': evidence,
-        'extras': {
-            # voice/chat apps usually can't handle group questions well
-            'disable_groups': no_groups
-        }
-    }
-    return call_endpoint('diagnosis', auth_string, None, request_spec, case_id,
-                         language_model)
+    request_spec = _diagnosis_request(evidence, age, sex, no_groups)
+    return _call_interview_endpoint('diagnosis', request_spec, case_id,
+                                    auth_string, language_model,
+                                    DIAGNOSIS_FIELDS, no_groups)
 
 
 def call_triage(evidence, age, sex, case_id, auth_string, language_model=None):
@@ -96,8 +522,30 @@ def call_triage(evidence, age, sex, case_id, auth_string, language_model=None):
         'sex': sex,
         'evidence': evidence
     }
-    return call_endpoint('triage', auth_string, None, request_spec, case_id,
-                         language_model)
+    return _call_interview_endpoint('triage', request_spec, case_id,
+                                    auth_string, language_model, None)
+
+
+def _parse_request(age, sex, text, context, conc_types):
+    return {
+       'age': age,
+       'sex': sex,
+       'text': text,
+       'context': list(context),
+       'include_tokens': True,
+       'concept_types': conc_types,
+       }
+
+
+def _parse_key(request_spec, language_model):
+    # Messages are often the same short phrases; the exact age doesn't matter
+    # much for understanding them.
+    return responsecache.make_key(
+        'parse', ' '.join(request_spec['text'].lower().split()),
+        request_spec['sex'],
+        responsecache.age_band(request_spec['age'], constants.AGE_BANDS),
+        request_spec['context'], list(request_spec['concept_types']),
+        language_model)
 
 
 def call_parse(age, sex, text, auth_string, case_id, context=(),
@@ -112,38 +560,68 @@ def call_parse(age, sex, text, auth_string, case_id, context=(),
     far, in the order of reporting. 
     See https://developer.infermedica.com/docs/nlp ("contextual clues").
     """
-    request_spec = {
-       'age': age,
-       'sex': sex,
-       'text': text,
-       'context': list(context),
-       'include_tokens': True,
-       'concept_types': conc_types,
-       }
-    return call_endpoint('parse', auth_string, None, request_spec, case_id,
-                         language_model=language_model)
+    request_spec = _parse_request(age, sex, text, context, conc_types)
+    if parse_cache is None:
+        return call_endpoint('parse', auth_string, None, request_spec, case_id,
+                             language_model=language_model)
+    key = _parse_key(request_spec, language_model)
+    return parse_cache.get_or_call(
+        key, lambda: call_endpoint('parse', auth_string, None, request_spec,
+                                   case_id, language_model=language_model))
+
+
+def _naming_params(age):
+    return {'age.value': age['value'], 'age.unit': age['unit']}
+
+
+def _names(observations):
+    return {struct['id']: struct['name'] for struct in observations}
 
 
-def get_observation_names(age, auth_string, case_id, language_model=None):
+def _common_names(observations):
+    return {struct['id']: struct['common_name'] for struct in observations
+            if struct.get('common_name')
+            and struct['common_name'] != struct['name']}
+
+
+def get_observation_catalog(age, auth_string, case_id, language_model=None,
+                            priority=ratelimit.INTERACTIVE):
+    """Like get_observation_names, but return the common names too (e.g.
+    "Stomach ache" for "Abdominal pain"), of the observations that have one
+    other than their name, as a second id2name mapping."""
+    params = _naming_params(age)
+
+    def fetch(endpoint):
+        return call_endpoint(endpoint, auth_string, params, None, case_id,
+                             language_model, priority=priority,
+                             projection=NAMING_FIELDS)
+
+    # The two lists are independent, fetch them concurrently.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        risk_factors = executor.submit(fetch, 'risk_factors')
+        symptoms = executor.submit(fetch, 'symptoms')
+        observations = risk_factors.result() + symptoms.result()
+    return _names(observations), _common_names(observations)
+
+
+def get_observation_names(age, auth_string, case_id, language_model=None,
+                          priority=ratelimit.INTERACTIVE):
     """Call /symptoms and /risk_factors to obtain full lists of all symptoms
     and risk factors along with their metadata. Those metadata include names
     and this is what we're after. Observations may contain both symptoms and
     risk factors. Their ids indicate concept type (symptoms are prefixed s_,
     risk factors -- p_)."""
-    obs_structs = []
-    obs_structs.extend(
-        call_endpoint('risk_factors', auth_string,
-                      {'age.value': age['value'], 'age.unit': age['unit']},
-                      None, case_id=case_id, language_model=language_model))
-    obs_structs.extend(
-        call_endpoint('symptoms', auth_string,
-                      {'age.value': age['value'], 'age.unit': age['unit']},
-                      None, case_id=case_id, language_model=language_model))
-    return {struct['id']: struct['name'] for struct in obs_structs}
+    return get_observation_catalog(age, auth_string, case_id,
+                                   language_model, priority)[0]
 
 
 def name_evidence(evidence, naming):
-    """Add "name" field to each piece of evidence."""
+    """Add "name" field to each piece of evidence. Pieces of an
+    evidencestore.EvidenceStore are shared, so the store gets the naming to
+    use instead (see EvidenceStore.as_dicts)."""
+    if isinstance(evidence, evidencestore.EvidenceStore):
+        evidence.naming = naming
+        return
     for piece in evidence:
         piece['name'] = naming[piece['id']]
 
@@ -161,3 +639,21 @@ def question_answer_to_evidence(question_struct_item, observation_value):
     question with the given observation value (status)."""
     return [{'id': question_struct_item['id'],
              'choice_id': observation_value}]
+
+
+def group_answers_to_evidence(question_struct, observation_values):
+    """Return new evidence obtained via answering the items of a group
+    question; observation_values maps item ids to observation values
+    (statuses), unanswered items being left out. Of a "group_single"
+    question only the chosen (present) item is reported if there is one, as
+    recommended in
+    https://developer.infermedica.com/docs/diagnosis#group_single"""
+    items = [item for item in question_struct['items']
+             if item['id'] in observation_values]
+    if question_struct['type'] == 'group_single':
+        chosen = [item for item in items
+                  if observation_values[item['id']] == 'present']
+        if chosen:
+            items = chosen[:1]
+    return [{'id': item['id'], 'choice_id': observation_values[item['id']]}
+            for item in items]
@@ -0,0 +1,213 @@
+"""Asyncio twins of the blocking calls from apiaccess.
+
+The functions here take the same arguments and return the same structures as
+their apiaccess counterparts, but they are coroutines, so that many
+conversations can be handled by one event loop. The resilience policy,
+caches and rate limits of apiaccess apply to them as well. Only single HTTP
+attempts go through the shared pooled session of apiaccess, run by a small
+pool of threads (one per pooled connection); waiting for the rate limiter,
+between retries and for a call already in flight (see
+apiaccess.coalesce_requests) is done by the coroutines themselves, so it
+doesn't hold any thread.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+import apiaccess
+import constants
+import metrics
+import ratelimit
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_max_workers = constants.HTTP_POOL_SIZE
+
+
+def configure(max_workers):
+    """Sets the number of concurrent HTTP calls (should match the pool size
+    given to apiaccess.configure_transport). Takes effect for new calls."""
+    global _executor, _max_workers
+    with _executor_lock:
+        _max_workers = max_workers
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=_max_workers,
+                    thread_name_prefix='apiaccess')
+    return _executor
+
+
+async def _run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def _throttle(endpoint, auth_string, case_id, priority):
+    """See apiaccess._throttle."""
+    app_id = (auth_string or '').split(':')[0]
+    scheduler = ratelimit.get_scheduler(app_id)
+    if scheduler is not None:
+        await scheduler.acquire_async(endpoint, case_id, priority)
+
+
+async def _call_once(endpoint, auth_string, params, request_spec, case_id,
+                     language_model, timeout, priority, projection):
+    await _throttle(endpoint, auth_string, case_id, priority)
+    return await _run(apiaccess._attempt, endpoint, auth_string, params,
+                      request_spec, case_id, language_model, timeout,
+                      projection)
+
+
+async def _hedged(attempt, labels):
+    """Awaits attempt() and, if it hasn't returned after the hedge delay
+    (see apiaccess.hedge_quantile), a second attempt too; returns the
+    first successful result of the two (see resilience.hedged_call)."""
+    hedge_delay = apiaccess._hedge_delay(labels)
+    if hedge_delay is None:
+        return await attempt()
+    tasks = [asyncio.ensure_future(attempt())]
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=hedge_delay)
+        if done:
+            return tasks[0].result()
+        metrics.registry.count('hedges_total', labels)
+        tasks.append(asyncio.ensure_future(attempt()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        return tasks[0].result()
+    finally:
+        for task in tasks:
+            task.cancel()  # the slower one (its HTTP attempt isn't stopped)
+
+
+async def _resilient(endpoint, language_model, attempt):
+    """See apiaccess._resilient; waits between the attempts in the
+    coroutine."""
+    breaker = apiaccess._breaker(endpoint)
+    labels = apiaccess._labels(endpoint, language_model)
+    attempt_no = 1
+    while True:
+        with breaker.calling(endpoint):
+            try:
+                result = await _hedged(attempt, labels)
+            except (IOError, ValueError) as e:
+                apiaccess._record_failure(breaker, e)
+                error = e
+            else:
+                breaker.record_success()
+                return result
+        delay = apiaccess._retry_delay(endpoint, labels, error, attempt_no)
+        if delay is None:
+            raise error
+        await asyncio.sleep(delay)
+        attempt_no += 1
+
+
+async def call_endpoint(endpoint, auth_string, params, request_spec, case_id,
+                        language_model=None, timeout=None,
+                        priority=ratelimit.INTERACTIVE, projection=None):
+    """See apiaccess.call_endpoint."""
+    if apiaccess.replayer is not None:
+        return await _run(apiaccess.call_endpoint, endpoint, auth_string,
+                          params, request_spec, case_id,
+                          language_model=language_model, timeout=timeout,
+                          priority=priority, projection=projection)
+    call = functools.partial(
+        _resilient, endpoint, language_model, functools.partial(
+            _call_once, endpoint, auth_string, params, request_spec, case_id,
+            language_model, timeout, priority, projection))
+    key = apiaccess.flight_key(endpoint, auth_string, params, request_spec,
+                               language_model, projection)
+    if key is None:
+        return await call()
+    return await apiaccess.flights.do_async(key, call)
+
+
+async def _cached(cache, key, call):
+    """Returns the response cached under the key or, if there's none, the
+    result of await call() (caching it)."""
+    response = await _run(cache.get, key)
+    if response is None:
+        response = await call()
+        await _run(cache.put, key, response)
+    return response
+
+
+async def _call_interview_endpoint(endpoint, request_spec, case_id,
+                                   auth_string, language_model, projection,
+                                   *key_parts):
+    def call():
+        return call_endpoint(endpoint, auth_string, None, request_spec,
+                             case_id, language_model, projection=projection)
+    cache = apiaccess.interview_cache
+    if cache is None:
+        return await call()
+    return await _cached(cache, apiaccess._interview_key(
+        endpoint, request_spec, language_model, *key_parts), call)
+
+
+async def call_diagnosis(evidence, age, sex, case_id, auth_string,
+                         no_groups=True, language_model=None):
+    """See apiaccess.call_diagnosis."""
+    request_spec = apiaccess._diagnosis_request(evidence, age, sex, no_groups)
+    return await _call_interview_endpoint(
+        'diagnosis', request_spec, case_id, auth_string, language_model,
+        apiaccess.DIAGNOSIS_FIELDS, no_groups)
+
+
+async def call_triage(evidence, age, sex, case_id, auth_string,
+                      language_model=None):
+    """See apiaccess.call_triage."""
+    request_spec = {'age': age, 'sex': sex, 'evidence': evidence}
+    return await _call_interview_endpoint('triage', request_spec, case_id,
+                                          auth_string, language_model, None)
+
+
+async def call_parse(age, sex, text, auth_string, case_id, context=(),
+                     conc_types=('symptom', 'risk_factor',),
+                     language_model=None):
+    """See apiaccess.call_parse."""
+    request_spec = apiaccess._parse_request(age, sex, text, context,
+                                            conc_types)
+
+    def call():
+        return call_endpoint('parse', auth_string, None, request_spec,
+                             case_id, language_model=language_model)
+    cache = apiaccess.parse_cache
+    if cache is None:
+        return await call()
+    return await _cached(cache,
+                         apiaccess._parse_key(request_spec, language_model),
+                         call)
+
+
+async def get_observation_names(age, auth_string, case_id,
+                                language_model=None,
+                                priority=ratelimit.INTERACTIVE):
+    """See apiaccess.get_observation_names."""
+    params = apiaccess._naming_params(age)
+    risk_factors, symptoms = await asyncio.gather(*(
+        call_endpoint(endpoint, auth_string, params, None, case_id,
+                      language_model, priority=priority,
+                      projection=apiaccess.NAMING_FIELDS)
+        for endpoint in ('risk_factors', 'symptoms')))
+    naming = apiaccess._names(risk_factors)
+    naming.update(apiaccess._names(symptoms))
+    return naming
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""Batch mode: runs scripted cases through the whole interview.
+
+Each case goes through /parse, the interview of conduct_interview (with the
+answers taken from the case instead of the user) and /triage; results are
+appended to a JSON lines file as cases finish. Cases are run by a pool of
+workers with a bounded number of cases in flight, so that huge case files
+are streamed rather than loaded. Cases already done in the output file are
+skipped, so an interrupted run is resumed simply by starting it again; cases
+that failed are run again then (the last result of a case is the one that
+counts).
+
+Example:
+    Run the vignettes with 20 workers::
+
+        $ python3 batch.py APP_ID:APP_KEY cases.jsonl -o results.jsonl \\
+              --workers 20
+
+    A case (a JSON line, or a CSV row with the same columns) has "age",
+    "sex", "complaints" (text, or a list of messages) and optionally "id"
+    (line number by default) and "answers", the answer policy:
+
+    * a status or answer, e.g. "absent" or "no", given to every question;
+    * a list of those, given in turn (and repeated as needed);
+    * an object mapping observation ids to those, with an optional
+      "default" (otherwise "unknown").
+
+    In CSV, lists and objects are given as JSON.
+
+"""
+import argparse
+import collections
+import concurrent.futures
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+import apiaccess
+import chat
+import constants
+import conversation
+import localparse
+import server
+
+
+class CaseError(ValueError):
+    pass
+
+
+def _decision(answer):
+    """Turns "present" / "no" / "don't know" etc. into a status."""
+    try:
+        return conversation.extract_decision(answer, constants.ANSWER_NORM)
+    except (conversation.AmbiguousAnswerException, ValueError):
+        raise CaseError('not an answer: {!r}'.format(answer))
+
+
+def make_policy(spec):
+    """Returns the answer_question function (see
+    conversation.conduct_interview) that answers according to the policy
+    spec of a case."""
+    if spec is None or spec == '':
+        return lambda item, text: constants.BATCH_DEFAULT_ANSWER
+    if isinstance(spec, str):
+        decision = _decision(spec)
+        return lambda item, text: decision
+    if isinstance(spec, list):
+        decisions = itertools.cycle([_decision(answer) for answer in spec])
+        return lambda item, text: next(decisions)
+    if isinstance(spec, dict):
+        decisions = {obs_id: _decision(answer)
+                     for obs_id, answer in spec.items()}
+        default = decisions.pop('default', constants.BATCH_DEFAULT_ANSWER)
+        return lambda item, text: decisions.get(item['id'], default)
+    raise CaseError('unsupported answer policy: {!r}'.format(spec))
+
+
+def _csv_value(value):
+    if value and value.lstrip()[:1] in ('[', '{'):
+        return json.loads(value)
+    return value
+
+
+def read_cases(path):
+    """Yields the cases from a JSON lines or CSV file (by extension), each
+    with its "id"."""
+    with open(path, encoding='utf-8', newline='') as stream:
+        if path.lower().endswith('.csv'):
+            rows = ({field: _csv_value(value)
+                     for field, value in row.items()}
+                    for row in csv.DictReader(stream))
+        else:
+            rows = (json.loads(line) for line in stream if line.strip())
+        for number, case in enumerate(rows, 1):
+            case.setdefault('id', str(number))
+            if case['id'] in ('', None):
+                case['id'] = str(number)
+            yield case
+
+
+def done_case_ids(path):
+    """Returns ids of the cases done (without error) in the output file,
+    dropping a partly written last line left by a crash."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as stream:
+        content = stream.read()
+        end = content.rfind(b'\n') + 1
+        if end != len(content):
+            stream.truncate(end)
+    done = set()
+    for line in content[:end].splitlines():
+        if line.strip():
+            result = json.loads(line)
+            if result['error'] is None:
+                done.add(str(result['id']))
+            else:
+                done.discard(str(result['id']))
+    return done
+
+
+def run_case(case, auth_string, language_model=None, prefetch_triage=None,
+             max_questions=constants.BATCH_MAX_QUESTIONS, no_groups=True):
+    """Runs one case through the interview.
+
+    Args:
+        case (dict): Case (see module docstring).
+        auth_string (str): Authentication string.
+        language_model (str): Chosen language model.
+        prefetch_triage (str): Triage prefetch mode (see
+            conversation.conduct_interview).
+        max_questions (int): Number of questions after which the interview
+            is cut short.
+        no_groups (bool): Ask single questions only (items of group
+            questions are answered one by one by the policy).
+
+    Returns:
+        dict: Result with "id", "case_id", "evidence", "diagnoses",
+            "triage_level", "questions" (items answered), "seconds"
+            (timings) and "error"
+            (None unless the case failed).
+
+    """
+    case_id = chat.new_case_id()
+    result = {'id': case['id'], 'case_id': case_id, 'evidence': None,
+              'diagnoses': None, 'triage_level': None, 'questions': 0,
+              'seconds': {}, 'error': None}
+    started = time.perf_counter()
+    try:
+        age = {'value': int(case['age']), 'unit': 'year'}
+        sex = conversation.extract_sex(str(case['sex']), constants.SEX_NORM)
+        policy = make_policy(case.get('answers'))
+        complaints = case.get('complaints') or []
+        if isinstance(complaints, str):
+            complaints = [complaints]
+
+        mentions = []
+        context = []
+        for text in complaints:
+            portion = localparse.parse(age, sex, text, auth_string, case_id,
+                                       context, language_model=language_model)
+            mentions.extend(portion)
+            context.extend(conversation.context_from_mentions(portion))
+        parsed = time.perf_counter()
+        result['seconds']['parse'] = round(parsed - started, 4)
+        if not mentions:
+            raise CaseError('no complaints recognised')
+
+        def answer_question(item, text):
+            result['questions'] += 1
+            return policy(item, text)
+        evidence, diagnoses, triage = conversation.conduct_interview(
+            apiaccess.mentions_to_evidence(mentions), age, sex, case_id,
+            auth_string, language_model, prefetch_triage=prefetch_triage,
+            answer_question=answer_question, max_questions=max_questions,
+            no_groups=no_groups)
+        result['seconds']['interview'] = round(
+            time.perf_counter() - parsed, 4)
+        result['evidence'] = [dict(piece) for piece in evidence]
+        result['diagnoses'] = [
+            {'id': diag['id'], 'name': diag['name'],
+             'probability': diag['probability']} for diag in diagnoses]
+        result['triage_level'] = triage['triage_level']
+    except Exception as e:
+        # whatever goes wrong with one case, the others go on (and it's
+        # retried on resume)
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds']['total'] = round(time.perf_counter() - started, 4)
+    return result
+
+
+def run_batch(cases, output, auth_string, workers, in_flight=None,
+              language_model=None, prefetch_triage=None,
+              max_questions=constants.BATCH_MAX_QUESTIONS, no_groups=True):
+    """Runs the cases (skipping the ones already done in the output file)
+    and appends the results to the output file as they come.
+
+    Returns:
+        collections.Counter: Numbers of cases "done", "failed" and
+            "skipped".
+
+    """
+    stats = collections.Counter()
+    done = done_case_ids(output)
+    in_flight = in_flight or 2 * workers
+    pending = set()
+    with open(output, 'a', encoding='utf-8') as stream, \
+            concurrent.futures.ThreadPoolExecutor(workers) as executor:
+
+        def write_finished(futures):
+            for future in futures:
+                result = future.result()
+                stream.write(json.dumps(result, ensure_ascii=False) + '\n')
+                stream.flush()
+                stats['failed' if result['error'] else 'done'] += 1
+
+        for case in cases:
+            if str(case['id']) in done:
+                stats['skipped'] += 1
+                continue
+            if len(pending) >= in_flight:
+                finished, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                write_finished(finished)
+            pending.add(executor.submit(
+                run_case, case, auth_string, language_model, prefetch_triage,
+                max_questions, no_groups))
+        write_finished(concurrent.futures.as_completed(pending))
+    return stats
+
+
+def parse_args():
+    parser = server.add_api_arguments(argparse.ArgumentParser())
+    parser.add_argument("cases", help="JSON lines or CSV file with cases")
+    parser.add_argument("-o", "--output", required=True,
+                        help="JSON lines file to append the results to "
+                             "(cases already done there are skipped)")
+    parser.add_argument("--workers", type=int,
+                        default=constants.HTTP_POOL_SIZE,
+                        help="number of cases run at a time")
+    parser.add_argument("--in-flight", type=int,
+                        help="maximum number of cases read ahead (twice the "
+                             "workers by default)")
+    parser.add_argument("--max-questions", type=int,
+                        default=constants.BATCH_MAX_QUESTIONS,
+                        help="questions after which an interview is cut "
+                             "short")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    auth_string = server.setup(args)
+    apiaccess.configure_transport(pool_size=args.workers)
+    started = time.perf_counter()
+    stats = run_batch(read_cases(args.cases), args.output, auth_string,
+                      args.workers, args.in_flight, args.model,
+                      args.prefetch_triage, args.max_questions,
+                      not args.group_questions)
+    print('{} done, {} failed, {} skipped in {:.1f} s'.format(
+        stats['done'], stats['failed'], stats['skipped'],
+        time.perf_counter() - started), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run()
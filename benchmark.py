@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Load and latency benchmark of the chatbot.
+
+Drives a number of scripted conversations concurrently through
+conversation.step (the same code that serves the real users) against the
+local mock API (see mockserver.py) or any other API URL, and reports:
+
+* throughput (sessions and turns per second),
+* p50/p95/p99 latency of a conversation turn and of each API endpoint,
+* memory held per live session.
+
+Example:
+    200 sessions, 50 at a time, with 50 ms of emulated API latency::
+
+        $ python3 benchmark.py --sessions 200 --concurrency 50 --latency 0.05
+
+    A session script is a JSON object with "age_sex", "complaints" (list of
+    messages) and "answers" (list of answers, repeated as needed); use
+    --scripts to run the ones from a JSON lines file.
+
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import threading
+import time
+import tracemalloc
+
+import apiaccess
+import chat
+import conversation
+import localparse
+import metrics
+import mockserver
+import ratelimit
+import traffic
+
+
+DEFAULT_SCRIPTS = [
+    {'age_sex': '30 male', 'complaints': ['headache', 'fever'],
+     'answers': ['yes', 'no', 'dont know']},
+    {'age_sex': '45 female', 'complaints': ['abdominal pain and nausea'],
+     'answers': ['no', 'yes']},
+    {'age_sex': '67 m', 'complaints': ['cough, no fever', 'smoking'],
+     'answers': ['no']},
+    {'age_sex': 'woman 23', 'complaints': ['pain while urinating'],
+     'answers': ['yes', 'yes', 'no', 'skip']},
+]
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of the values (0.0 if none)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1,
+                      int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+class Recorder:
+    """Collects timings from many threads."""
+
+    def __init__(self):
+        self.timings = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+
+def run_session(script, auth_string, recorder, language_model=None,
+                prefetch_triage=None, no_groups=True):
+    """Runs one scripted conversation to the end.
+
+    Returns:
+        conversation.InterviewState: Final state.
+
+    """
+    state = conversation.InterviewState(chat.new_case_id())
+    conversation.start(state)
+    messages = [script['age_sex']] + list(script['complaints']) + ['']
+    answers = script.get('answers') or ['skip']
+    turn = 0
+    while not state.finished:
+        if turn < len(messages):
+            text = messages[turn]
+        else:
+            text = answers[(turn - len(messages)) % len(answers)]
+        turn += 1
+        started = time.perf_counter()
+        conversation.step(state, text, auth_string, language_model,
+                          prefetch_triage, no_groups)
+        recorder.add('turn', time.perf_counter() - started)
+        if turn > 1000:
+            raise RuntimeError('Conversation does not finish.')
+    return state
+
+
+def run_sessions(scripts, sessions, concurrency, auth_string, recorder,
+                 language_model=None, prefetch_triage=None, no_groups=True):
+    """Runs the sessions, concurrency at a time, and returns their final
+    states."""
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        futures = [executor.submit(run_session, scripts[idx % len(scripts)],
+                                   auth_string, recorder, language_model,
+                                   prefetch_triage, no_groups)
+                   for idx in range(sessions)]
+        return [future.result() for future in futures]
+
+
+def benchmark(scripts, sessions, concurrency, auth_string,
+              language_model=None, prefetch_triage=None, no_groups=True):
+    """Runs the sessions and returns the report (a dict). Memory is measured
+    in a separate pass, of concurrency sessions: tracing allocations slows
+    everything down too much to be done while timing."""
+    recorder = Recorder()
+    apiaccess.configure_transport(pool_size=concurrency)
+
+    def time_endpoint(call):
+        recorder.add('/' + call['endpoint'], call['seconds'])
+    metrics.add_hook(time_endpoint)
+    try:
+        started = time.perf_counter()
+        states = run_sessions(scripts, sessions, concurrency, auth_string,
+                              recorder, language_model, prefetch_triage,
+                              no_groups)
+        elapsed = time.perf_counter() - started
+    finally:
+        metrics.remove_hook(time_endpoint)
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        measured = run_sessions(scripts, concurrency, concurrency,
+                                auth_string, Recorder(), language_model,
+                                prefetch_triage, no_groups)
+        held = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+    turns = len(recorder.timings['turn'])
+    report = {
+        'sessions': sessions,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'sessions_per_second': round(sessions / elapsed, 2),
+        'turns_per_second': round(turns / elapsed, 2),
+        'bytes_per_session': held // max(1, len(measured)),
+        'serialised_bytes_per_session': sum(
+            len(state.dumps()) for state in states) // max(1, len(states)),
+        'latency': {},
+    }
+    for name, values in sorted(recorder.timings.items()):
+        report['latency'][name] = {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2)}
+    return report
+
+
+def print_report(report):
+    print('{sessions} sessions, {concurrency} at a time, in {seconds} s'
+          .format(**report))
+    print('{sessions_per_second} sessions/s, {turns_per_second} turns/s'
+          .format(**report))
+    print('{bytes_per_session} B per live session ({serialised_bytes_per_'
+          'session} B serialised)'.format(**report))
+    print()
+    print('{:<16}{:>8}{:>10}{:>10}{:>10}'.format('', 'count', 'p50 ms',
+                                                 'p95 ms', 'p99 ms'))
+    for name, stats in report['latency'].items():
+        print('{:<16}{count:>8}{p50_ms:>10}{p95_ms:>10}{p99_ms:>10}'
+              .format(name, **stats))
+
+
+def load_scripts(path):
+    with open(path, encoding='utf-8') as stream:
+        return [json.loads(line) for line in stream if line.strip()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100,
+                        help="number of conversations to run")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="number of conversations run at a time")
+    parser.add_argument("--scripts",
+                        help="JSON lines file with session scripts")
+    parser.add_argument("--api-url",
+                        help="API base URL (by default a mock API is started "
+                             "in-process)")
+    parser.add_argument("--auth", default="bench:bench",
+                        help="APP_ID:APP_KEY to send")
+    parser.add_argument("--model", help="language model to request")
+    parser.add_argument("--prefetch-triage", choices=("always", "near_stop"),
+                        help="triage prefetch mode")
+    parser.add_argument("--group-questions", action="store_true",
+                        help="let /diagnosis ask group questions (fewer "
+                             "round trips per interview)")
+    parser.add_argument("--no-local-parse", action="store_true",
+                        help="always call /parse, even for complaints that "
+                             "can be understood from the catalog")
+    parser.add_argument("--latency", action="append",
+                        help="mock API latency, as in mockserver.py")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="mock API latency jitter")
+    parser.add_argument("--replay", action="append",
+                        help="recorded traffic for the mock API to serve")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of mock API requests to fail")
+    parser.add_argument("--hedge-quantile", type=float,
+                        help="hedge calls slower than this latency quantile "
+                             "of their endpoint (e.g. 0.95)")
+    parser.add_argument("--rate-limit", action="append",
+                        help="API calls per second (and burst) allowed per "
+                             "App-Id, either in total (e.g. 10 or 10:20) or "
+                             "per endpoint (e.g. parse=5:10); may be "
+                             "repeated")
+    parser.add_argument("--json", action="store_true",
+                        help="print the report as JSON")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    scripts = load_scripts(args.scripts) if args.scripts else DEFAULT_SCRIPTS
+    server = None
+    api_url = args.api_url
+    if api_url is None:
+        recordings = {}
+        for path in args.replay or ():
+            recordings.update(traffic.load_recordings(path))
+        api = mockserver.MockApi(recordings,
+                                 mockserver.parse_latency(args.latency),
+                                 args.jitter, error_rate=args.error_rate)
+        server, api_url = mockserver.start_in_thread(api)
+    apiaccess.configure_transport(base_url=api_url)
+    apiaccess.hedge_quantile = args.hedge_quantile
+    localparse.configure(enabled=not args.no_local_parse)
+    ratelimit.configure(**ratelimit.parse_limits(args.rate_limit))
+    try:
+        report = benchmark(scripts, args.sessions, args.concurrency,
+                           args.auth, args.model, args.prefetch_triage,
+                           not args.group_questions)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,257 @@
+"""Process-wide cache of observation names.
+
+Names of all the symptoms and risk factors are needed to present the evidence
+to the user, but the lists served by /symptoms and /risk_factors are large and
+don't change between sessions. This module keeps one id2name mapping per
+language model and age bucket (along with the common names of the
+observations, see peek_common_names), shared by all the sessions handled by
+the process, and optionally snapshots it to disk so that a fresh worker can
+start without downloading it.
+
+Snapshots are catalog files (see catalogfile.py): a catalog read from a
+snapshot is memory-mapped rather than loaded, so the worker processes of a
+host share one copy of it.
+"""
+import collections.abc
+import json
+import os
+import threading
+import time
+
+import requests
+
+import apiaccess
+import catalogfile
+import constants
+import ratelimit
+import responsecache
+import singleflight
+
+
+# (language_model, age bucket) -> (load time, naming, common names)
+_catalogs = {}
+_failures = {}  # (language_model, age bucket) -> time of failed download
+_lock = threading.Lock()
+# Downloads are made without holding _lock, one at a time per catalog.
+_downloads = singleflight.Group('catalog', copy_results=False)
+_ttl = constants.CATALOG_TTL
+_snapshot_dir = None
+
+
+def configure(ttl=None, snapshot_dir=None):
+    """Sets up the cache.
+
+    Args:
+        ttl (float): Number of seconds after which a catalog is re-fetched.
+        snapshot_dir (str): Directory to keep catalog snapshots in. Catalogs
+            are stored there after each download and read from there when not
+            in memory yet.
+
+    """
+    global _ttl, _snapshot_dir
+    if ttl is not None:
+        _ttl = ttl
+    if snapshot_dir is not None:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        _snapshot_dir = snapshot_dir
+
+
+def age_bucket(age):
+    """Returns the lower bound of the age band the given age falls into.
+
+    Args:
+        age (dict): Patients age in {'value': int, 'unit': str} format.
+
+    Returns:
+        int: Age (in years) that represents the band.
+
+    """
+    return responsecache.age_band(age, constants.AGE_BANDS)
+
+
+def _snapshot_path(key, extension='cat'):
+    language_model, bucket = key
+    return os.path.join(_snapshot_dir, 'catalog-{}-{}.{}'.format(
+        language_model or 'default', bucket, extension))
+
+
+def _read_snapshot(key):
+    """Returns (modification time, naming, common names) or None if there's
+    no snapshot. JSON snapshots of older versions are converted to catalog
+    files (without common names)."""
+    if _snapshot_dir is None:
+        return None
+    path = _snapshot_path(key)
+    try:
+        naming = catalogfile.MappedCatalog(path)
+    except (FileNotFoundError, ValueError):
+        pass
+    else:
+        try:
+            common_names = catalogfile.MappedCatalog(
+                _snapshot_path(key, 'common.cat'))
+        except (FileNotFoundError, ValueError):
+            common_names = None
+        return os.path.getmtime(path), naming, common_names
+    legacy_path = _snapshot_path(key, 'json')
+    try:
+        with open(legacy_path, encoding='utf-8') as stream:
+            naming = json.load(stream)
+    except (FileNotFoundError, ValueError):
+        return None
+    catalogfile.write(path, naming)
+    os.utime(path, (time.time(), os.path.getmtime(legacy_path)))
+    return os.path.getmtime(path), catalogfile.MappedCatalog(path), None
+
+
+def _fetch(key, auth_string, case_id, priority=ratelimit.INTERACTIVE):
+    """Downloads the catalog; returns the naming and the common names. With
+    snapshots on, they're written to disk and the mapped snapshots are
+    returned instead of the downloaded dicts."""
+    language_model, bucket = key
+    naming, common_names = apiaccess.get_observation_catalog(
+        {'value': bucket, 'unit': 'year'}, auth_string, case_id,
+        language_model, priority)
+    if _snapshot_dir is None:
+        return naming, common_names
+    paths = _snapshot_path(key), _snapshot_path(key, 'common.cat')
+    catalogfile.write(paths[1], common_names)
+    catalogfile.write(paths[0], naming)
+    return (catalogfile.MappedCatalog(paths[0]),
+            catalogfile.MappedCatalog(paths[1]))
+
+
+def get_naming(age, auth_string, case_id, language_model=None, lazy=False):
+    """Returns id2name mapping for all the observations.
+
+    The mapping is taken from memory, from a disk snapshot or downloaded, in
+    that order. Expired mappings are downloaded again; if that fails, the
+    stale one is still served, and the download isn't tried again for
+    CATALOG_RETRY_DELAY seconds.
+
+    Args:
+        age (dict): Patients age in {'value': int, 'unit': str} format.
+        auth_string (str): Authentication string.
+        case_id (str): Case ID (used only if the catalog must be downloaded).
+        language_model (str): Chosen language model.
+        lazy (bool): Don't load anything until the mapping is first used.
+
+    Returns:
+        Mapping: Observation names keyed by observation ids.
+
+    """
+    if lazy:
+        return LazyNaming(age, auth_string, case_id, language_model)
+    key = (language_model, age_bucket(age))
+    entry = _cached(key)
+    now = time.time()
+    if entry is not None and (
+            now - entry[0] < _ttl
+            or now - _failures.get(key, 0) < constants.CATALOG_RETRY_DELAY):
+        return entry[1]
+    try:
+        naming = _download(key, auth_string, case_id)
+    except (IOError, requests.RequestException):
+        with _lock:
+            _failures[key] = time.time()
+        if entry is None:
+            raise
+        return entry[1]
+    return naming
+
+
+def _cached(key):
+    """Returns (load time, naming, common names) from memory or a
+    snapshot, or None."""
+    with _lock:
+        entry = _catalogs.get(key)
+    if entry is None:
+        entry = _read_snapshot(key)
+        if entry is not None:
+            with _lock:
+                entry = _catalogs.setdefault(key, entry)
+    return entry
+
+
+def _download(key, auth_string, case_id, priority=ratelimit.INTERACTIVE):
+    """Downloads the catalog (joining a download of it in progress) and
+    keeps it in memory."""
+    def fetch():
+        naming, common_names = _fetch(key, auth_string, case_id, priority)
+        with _lock:
+            _catalogs[key] = time.time(), naming, common_names
+            _failures.pop(key, None)
+        return naming
+    return _downloads.do(key, fetch)
+
+
+def peek(age, language_model=None):
+    """Returns id2name mapping for all the observations if it's at hand (in
+    memory or in a disk snapshot, expired or not), None otherwise. Never
+    downloads anything.
+
+    Args:
+        age (dict): Patients age in {'value': int, 'unit': str} format.
+        language_model (str): Chosen language model.
+
+    Returns:
+        Mapping: Observation names keyed by observation ids (or None).
+
+    """
+    entry = _cached((language_model, age_bucket(age)))
+    return entry[1] if entry is not None else None
+
+
+def peek_common_names(age, language_model=None):
+    """Returns the common names of the observations (e.g. "Stomach ache"
+    for "Abdominal pain"; only the ones other than the name) if they're at
+    hand along with the catalog (see peek), None otherwise.
+
+    Args:
+        age (dict): Patients age in {'value': int, 'unit': str} format.
+        language_model (str): Chosen language model.
+
+    Returns:
+        Mapping: Common names keyed by observation ids (or None).
+
+    """
+    entry = _cached((language_model, age_bucket(age)))
+    return entry[2] if entry is not None else None
+
+
+def refresh(auth_string, case_id):
+    """Downloads again all the catalogs kept in memory. The calls give way
+    to the interactive ones when rate limited."""
+    with _lock:
+        keys = list(_catalogs)
+    for key in keys:
+        _download(key, auth_string, case_id, ratelimit.BACKGROUND)
+
+
+def invalidate():
+    """Drops all the catalogs kept in memory (snapshots are left intact)."""
+    with _lock:
+        _catalogs.clear()
+        _failures.clear()
+
+
+class LazyNaming(collections.abc.Mapping):
+    """id2name mapping that is fetched from the cache on first access."""
+
+    def __init__(self, age, auth_string, case_id, language_model=None):
+        self._args = (age, auth_string, case_id, language_model)
+        self._naming = None
+
+    def _load(self):
+        if self._naming is None:
+            self._naming = get_naming(*self._args)
+        return self._naming
+
+    def __getitem__(self, obs_id):
+        return self._load()[obs_id]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
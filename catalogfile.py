@@ -0,0 +1,141 @@
+"""Compact on-disk observation catalog, shared by processes through mmap.
+
+A catalog file holds an id2name mapping in a form that's queried in place:
+
+* header: MAGIC, number of entries and size of the id blob;
+* two offsets tables (little-endian uint32, one more than entries): of the
+  ids within the id blob and of the names within the name blob;
+* the id blob: UTF-8 ids, sorted bytewise;
+* the name blob: UTF-8 names, in the order of the ids.
+
+A MappedCatalog maps the file read-only and finds ids by binary search, so
+all the processes on a host share the same page cache copy of a catalog
+instead of each holding a dict of it, and a new process has the catalog as
+soon as it opens the file.
+"""
+import collections.abc
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b'OBSCAT1\0'
+_HEADER = struct.Struct('<8sII')
+_OFFSET = struct.Struct('<I')
+
+
+def write(path, naming):
+    """Writes the id2name mapping to a catalog file (atomically: readers
+    see either the old file or the new one)."""
+    entries = sorted((obs_id.encode('utf-8'), name.encode('utf-8'))
+                     for obs_id, name in naming.items())
+    id_offsets, name_offsets = [0], [0]
+    for obs_id, name in entries:
+        id_offsets.append(id_offsets[-1] + len(obs_id))
+        name_offsets.append(name_offsets[-1] + len(name))
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                     threading.get_ident())
+    with open(tmp_path, 'wb') as stream:
+        stream.write(_HEADER.pack(MAGIC, len(entries), id_offsets[-1]))
+        stream.write(struct.pack('<{}I'.format(len(entries) + 1),
+                                 *id_offsets))
+        stream.write(struct.pack('<{}I'.format(len(entries) + 1),
+                                 *name_offsets))
+        stream.write(b''.join(obs_id for obs_id, _ in entries))
+        stream.write(b''.join(name for _, name in entries))
+    os.replace(tmp_path, path)
+
+
+class MappedCatalog(collections.abc.Mapping):
+    """Read-only id2name mapping backed by a memory-mapped catalog file.
+
+    Args:
+        path (str): Catalog file (see write).
+
+    Raises:
+        ValueError: If the file is not a catalog file.
+
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as stream:
+            size = os.fstat(stream.fileno()).st_size
+            if size < _HEADER.size:
+                raise ValueError('not a catalog file: {}'.format(path))
+            self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        magic, self._count, ids_size = _HEADER.unpack_from(self._map)
+        table_size = (self._count + 1) * _OFFSET.size
+        self._id_table = _HEADER.size
+        self._name_table = self._id_table + table_size
+        self._ids = self._name_table + table_size
+        self._names = self._ids + ids_size
+        if magic != MAGIC or not self._valid(ids_size):
+            self._map.close()
+            raise ValueError('not a catalog file: {}'.format(path))
+
+    def _valid(self, ids_size):
+        """Tells whether the tables fit the file (so that a truncated or
+        corrupt file is rejected here rather than failing lookups)."""
+        if self._names > len(self._map):
+            return False
+        table_format = '<{}I'.format(self._count + 1)
+        for table, end in ((self._id_table, ids_size),
+                           (self._name_table, len(self._map) - self._names)):
+            offsets = struct.unpack_from(table_format, self._map, table)
+            if offsets[0] != 0 or offsets[-1] != end or any(
+                    start > stop for start, stop in zip(offsets,
+                                                        offsets[1:])):
+                return False
+        return True
+
+    def _offsets(self, table, idx):
+        start = table + idx * _OFFSET.size
+        return (_OFFSET.unpack_from(self._map, start)[0],
+                _OFFSET.unpack_from(self._map, start + _OFFSET.size)[0])
+
+    def _id(self, idx):
+        start, end = self._offsets(self._id_table, idx)
+        return self._map[self._ids + start:self._ids + end]
+
+    def _name(self, idx):
+        start, end = self._offsets(self._name_table, idx)
+        return self._map[self._names + start:self._names + end].decode(
+            'utf-8')
+
+    def _find(self, obs_id):
+        if not isinstance(obs_id, str):
+            return None
+        key = obs_id.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._id(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._id(low) == key:
+            return low
+        return None
+
+    def __getitem__(self, obs_id):
+        idx = self._find(obs_id)
+        if idx is None:
+            raise KeyError(obs_id)
+        return self._name(idx)
+
+    def __contains__(self, obs_id):
+        return self._find(obs_id) is not None
+
+    def __iter__(self):
+        return (self._id(idx).decode('utf-8') for idx in range(self._count))
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._map.close()
+
+    def __repr__(self):
+        return 'MappedCatalog({!r}, {} entries)'.format(self.path,
+                                                        self._count)
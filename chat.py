@@ -17,8 +17,10 @@ Note:
 import argparse
 import uuid
 
+import catalog
 import conversation
 import apiaccess
+import localparse
 
 
 def get_auth_string(auth_or_path):
@@ -62,9 +64,18 @@ def parse_args():
     """Parses command line arguments.
 
     Returns:
-        argparse.Namespace: Namespace containing three public attributes:
+        argparse.Namespace: Namespace containing ten public attributes:
             1. auth (str) - authentication credentials.
             2. model (str) - chosen language model.
+            3. catalog_dir (str) - directory for catalog snapshots.
+            4. prefetch_triage (str) - triage prefetch mode.
+            5. group_questions (bool) - whether to get group questions.
+            6. cache_db (str) - path of the response cache database.
+            7. record (str) - path of the traffic log to write.
+            8. replay (list) - paths of the traffic logs to replay.
+            9. no_local_parse (bool) - whether to always call /parse.
+            10. pipeline_complaints (bool) - whether to read complaints
+                while the earlier ones are being parsed.
     """
     parser = argparse.ArgumentParser()
     parser.add_argument("auth",
@@ -73,6 +84,30 @@ def parse_args():
     parser.add_argument("--model",
                         help="use non-standard Infermedica model/language, "
                              "e.g. infermedica-es")
+    parser.add_argument("--catalog-dir",
+                        help="directory to keep observation catalog "
+                             "snapshots in (lets the bot start without "
+                             "downloading them)")
+    parser.add_argument("--prefetch-triage", choices=("always", "near_stop"),
+                        help="call /triage along with /diagnosis to get the "
+                             "final results sooner")
+    parser.add_argument("--group-questions", action="store_true",
+                        help="let /diagnosis ask group questions (fewer "
+                             "round trips per interview)")
+    parser.add_argument("--record",
+                        help="log all API traffic to this file")
+    parser.add_argument("--replay", action="append",
+                        help="answer API calls from this traffic log instead "
+                             "of the network; may be repeated")
+    parser.add_argument("--cache-db",
+                        help="SQLite file to cache API responses in (may be "
+                             "shared by many bot processes)")
+    parser.add_argument("--no-local-parse", action="store_true",
+                        help="always call /parse, even for complaints that "
+                             "can be understood from the catalog")
+    parser.add_argument("--pipeline-complaints", action="store_true",
+                        help="keep reading complaints while the earlier ones "
+                             "are being parsed")
     args = parser.parse_args()
     return args
 
@@ -81,6 +116,15 @@ def run():
     """Runs the main application."""
     args = parse_args()
     auth_string = get_auth_string(args.auth)
+    catalog.configure(snapshot_dir=args.catalog_dir)
+    localparse.configure(enabled=not args.no_local_parse)
+    if args.cache_db:
+        apiaccess.configure_parse_cache(args.cache_db)
+        apiaccess.configure_interview_cache(args.cache_db)
+    if args.record:
+        apiaccess.record_traffic(args.record)
+    if args.replay:
+        apiaccess.replay_traffic(*args.replay)
     case_id = new_case_id()
 
     # Read patient's age and sex; required by /diagnosis endpoint.
@@ -89,22 +133,25 @@ def run():
     print(f"Ok, {age} year old {sex}.")
     age = {'value':  age, 'unit': 'year'}
 
-    # Query for all observation names and store them. In a real chatbot, this
-    # could be done once at initialisation and used for handling all events by
-    # one worker. This is an id2name mapping.
-    naming = apiaccess.get_observation_names(age, auth_string, case_id, args.model)
+    # Get names of all observations. These are shared by all sessions handled
+    # by the process and only fetched when first needed. This is an id2name
+    # mapping.
+    naming = catalog.get_naming(age, auth_string, case_id, args.model,
+                                lazy=True)
 
     # Read patient's complaints by using /parse endpoint.
-    mentions = conversation.read_complaints(age, sex, auth_string, case_id, args.model)
+    mentions = conversation.read_complaints(
+        age, sex, auth_string, case_id, args.model,
+        pipelined=args.pipeline_complaints)
 
     # Keep asking diagnostic questions until stop condition is met (all of this
     # by calling /diagnosis endpoint) and get the diagnostic ranking and triage
     # (the latter from /triage endpoint).
     evidence = apiaccess.mentions_to_evidence(mentions)
-    evidence, diagnoses, triage = conversation.conduct_interview(evidence, age,
-                                                                 sex, case_id,
-                                                                 auth_string,
-                                                                 args.model)
+    evidence, diagnoses, triage = conversation.conduct_interview(
+        evidence, age, sex, case_id, auth_string, args.model,
+        prefetch_triage=args.prefetch_triage,
+        no_groups=not args.group_questions)
 
     # Add `name` field to each piece of evidence to get a human-readable
     # summary.
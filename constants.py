@@ -3,6 +3,90 @@
 MIN_AGE = 12
 MAX_AGE = 130
 
+# HTTP transport used to talk to Infermedica API (timeouts in seconds).
+HTTP_POOL_SIZE = 10
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 30
+HTTP_STREAM_CHUNK_SIZE = 64 * 1024
+# Responses larger than this (in bytes) are decoded as they're downloaded
+# when only some of their fields are needed.
+JSON_STREAM_THRESHOLD = 256 * 1024
+
+# Lower bounds (in years) of age bands. Responses that hardly depend on the
+# exact age are shared by all the patients from the same band.
+AGE_BANDS = (12, 18, 65)
+
+# Resilience of the API calls (delays in seconds): retries with exponential
+# backoff, per-endpoint circuit breakers and the number of calls observed
+# before hedging kicks in.
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.2
+RETRY_MAX_DELAY = 5.0
+RETRY_AFTER_MAX = 30.0
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30.0
+HEDGE_MIN_SAMPLES = 20
+# With hedging on, every attempt is made by a thread of a pool of this size
+# (so that the caller can take whichever response comes first).
+HEDGE_POOL_SIZE = 64
+
+# Observation name catalogs are shared by all the sessions handled by the
+# process; they're kept per language model and age band and re-fetched after
+# CATALOG_TTL seconds.
+CATALOG_TTL = 24 * 60 * 60
+# After a failed download, an expired catalog is served as it is for this
+# many seconds before the download is tried again.
+CATALOG_RETRY_DELAY = 60
+
+# /parse response cache bounds (ttl in seconds).
+PARSE_CACHE_SIZE = 10000
+PARSE_CACHE_TTL = 24 * 60 * 60
+
+# /diagnosis and /triage response cache bounds (ttl in seconds).
+INTERVIEW_CACHE_SIZE = 10000
+INTERVIEW_CACHE_TTL = 6 * 60 * 60
+
+# Rotation of recorded API traffic logs.
+TRAFFIC_LOG_MAX_BYTES = 64 * 1024 * 1024
+TRAFFIC_LOG_BACKUP_COUNT = 5
+
+# Distinct pieces of evidence (observation, status, source) shared by all the
+# sessions of a process; it's bounded by the size of the catalog in practice.
+EVIDENCE_PIECES_MAX = 100000
+
+# Batch mode (see batch.py): answer given when a case doesn't say otherwise
+# and number of questions after which an interview is cut short.
+BATCH_DEFAULT_ANSWER = 'unknown'
+BATCH_MAX_QUESTIONS = 30
+
+# Complaints matched locally are checked against /parse with this
+# probability, to measure the matching accuracy (see localparse.py).
+LOCAL_PARSE_VERIFY_RATE = 0.01
+
+# Version of the serialised conversation state format.
+STATE_FORMAT_VERSION = 1
+
+# Server session store (see sessionstore.py): memory held by the sessions
+# kept in memory (bytes), number of locks shared by the sessions, and time
+# (seconds) after which an idle session spilled to disk is dropped.
+SESSION_STORE_MAX_BYTES = 64 * 1024 * 1024
+SESSION_LOCK_STRIPES = 64
+SESSION_IDLE_TTL = 24 * 60 * 60
+# A session store file shared by processes: time (seconds) for which a state
+# taken out by one of them is leased to it (unless it dies sooner), and time
+# that the others wait for the state, polling at the given interval.
+SESSION_LEASE_TTL = 5 * 60
+SESSION_LEASE_WAIT = 10.0
+SESSION_LEASE_POLL = 0.05
+
+# Workers of supervisor.py that die sooner than this (seconds) after start
+# are restarted only after this delay, so that a crash loop doesn't spin.
+SUPERVISOR_RESTART_DELAY = 1.0
+
+# In "near_stop" triage prefetch mode /triage is called along with /diagnosis
+# once the leading diagnosis reaches this probability.
+TRIAGE_PREFETCH_PROBABILITY = 0.6
+
 SEX_NORM = {
     "male": "male",
     "m": "male",
@@ -50,3 +134,27 @@ ANSWER_NORM = {
     "omita": "unknown",
     "salta": "unknown",
 }
+
+# Local matching of complaints (see localparse.py): words negating the
+# complaint they precede and words that don't change its meaning.
+NEGATION_NORM = {
+    "no": "absent",
+    "not": "absent",
+    "without": "absent",
+    "never": "absent",
+    "don't have": "absent",
+    "dont have": "absent",
+    "do not have": "absent",
+    "not sure about": "unknown",
+    "maybe": "unknown",
+    "sin": "absent",
+    "sem": "absent",
+    "não": "absent",
+    "nao": "absent",
+    "tal vez": "unknown",
+}
+
+COMPLAINT_FILLER_WORDS = frozenset([
+    "i", "i'm", "im", "am", "have", "has", "had", "got", "a", "an", "the",
+    "my", "some", "also", "feel", "feeling", "any", "tengo", "tenho",
+])
@@ -1,14 +1,79 @@
+import collections
+import concurrent.futures
+import json
 import re
 import sys
+import threading
 
 import apiaccess
+import catalog
 import constants
+import evidencestore
+import keywordmatch
+import localparse
 
 
 class AmbiguousAnswerException(Exception):
     pass
 
 
+# Counters of speculative /triage calls made by conduct_interview: "calls"
+# made, "hits" (used as the final triage) and "wasted" (discarded, of which
+# "cancelled" never reached the API).
+triage_prefetch_stats = collections.Counter()
+# Counters of pipelined complaint intake (see read_complaints): "parses"
+# dispatched and "reparses" of portions sent before the context was known.
+intake_stats = collections.Counter()
+_stats_lock = threading.Lock()
+_prefetch_executor = None
+_prefetch_executor_lock = threading.Lock()
+_parse_executor = None
+_parse_executor_lock = threading.Lock()
+
+_NUMBER_REGEX = re.compile(r"\b\d+\b")
+# A reply to a group question consisting of item numbers only (e.g. "1, 3").
+_NUMBER_LIST_REGEX = re.compile(
+    r"\s*\d+(?:\s*(?:[,;&]|\band\b)?\s*\d+)*\s*\.?\s*", re.IGNORECASE)
+# Words deciding about the items named in a clause of such a reply.
+_GROUP_DECISION_NORM = dict(constants.NEGATION_NORM, **constants.ANSWER_NORM)
+
+AGE_SEX_PROMPT = "Patient age and sex (e.g., 30 male)"
+COMPLAINTS_PROMPT = "Describe you complaints"
+GROUP_SINGLE_PROMPT = "Give the number of the answer that fits (or say no)"
+GROUP_MULTIPLE_PROMPT = ("Answer yes, no or don't know for each of them, or "
+                         "give the numbers of the ones that apply")
+
+
+def _count_prefetch(event):
+    with _stats_lock:
+        triage_prefetch_stats[event] += 1
+
+
+def _count_intake(event):
+    with _stats_lock:
+        intake_stats[event] += 1
+
+
+def _get_parse_executor():
+    global _parse_executor
+    if _parse_executor is None:
+        with _parse_executor_lock:
+            if _parse_executor is None:
+                _parse_executor = concurrent.futures.ThreadPoolExecutor(
+                    thread_name_prefix='complaint-parse')
+    return _parse_executor
+
+
+def _get_prefetch_executor():
+    global _prefetch_executor
+    if _prefetch_executor is None:
+        with _prefetch_executor_lock:
+            if _prefetch_executor is None:
+                _prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+                    thread_name_prefix='triage-prefetch')
+    return _prefetch_executor
+
+
 def read_input(prompt):
     """Displays appropriate prompt and reads the input.
 
@@ -41,23 +106,41 @@ def read_age_sex():
         int, str: Age and sex.
 
     """
-    answer = read_input("Patient age and sex (e.g., 30 male)")
-    try:
-        age = int(extract_age(answer))
-        sex = extract_sex(answer, constants.SEX_NORM)
-        if age < constants.MIN_AGE:
-            raise ValueError("Ages below 12 are not yet supported.")
-        if age > constants.MAX_AGE:
-            raise ValueError("Maximum possible age is 130.")
-    except (AmbiguousAnswerException, ValueError) as e:
-        print("{} Please repeat.".format(e))
-        return read_age_sex()
+    while True:
+        answer = read_input(AGE_SEX_PROMPT)
+        try:
+            return parse_age_sex(answer)
+        except (AmbiguousAnswerException, ValueError) as e:
+            print("{} Please repeat.".format(e))
+
+
+def parse_age_sex(text):
+    """Understands age and sex specification such as "30 male".
+
+    Args:
+        text (str): User message.
+
+    Returns:
+        int, str: Age and sex.
+
+    Raises:
+        AmbiguousAnswerException: If more than one age or sex is given.
+        ValueError: If age or sex is missing or age is not supported.
+
+    """
+    age = int(extract_age(text))
+    sex = extract_sex(text, constants.SEX_NORM)
+    if age < constants.MIN_AGE:
+        raise ValueError("Ages below 12 are not yet supported.")
+    if age > constants.MAX_AGE:
+        raise ValueError("Maximum possible age is 130.")
     return age, sex
 
 
 def read_complaint_portion(age, sex, auth_string, case_id, context, language_model=None):
     """Reads user input and calls the /parse endpoint of Infermedica API to
-    extract conditions found in text.
+    extract conditions found in text (unless they're understood locally, see
+    localparse.py).
 
     Args:
         age (dict): Patients age in {'value': int, 'unit': str} format.
@@ -68,15 +151,14 @@ def read_complaint_portion(age, sex, auth_string, case_id, context, language_mod
         language_model (str): Chosen language model.
 
     Returns:
-        dict: Response from /parse endpoint.
+        list: Mentions found in the text (None if there was no text).
 
     """
-    text = read_input('Describe you complaints')
+    text = read_input(COMPLAINTS_PROMPT)
     if not text:
         return None
-    resp = apiaccess.call_parse(age, sex, text, auth_string, case_id, context,
-                                language_model=language_model)
-    return resp.get('mentions', [])
+    return localparse.parse(age, sex, text, auth_string, case_id, context,
+                            language_model=language_model)
 
 
 def mention_as_text(mention):
@@ -101,12 +183,18 @@ def context_from_mentions(mentions):
     return [m['id'] for m in mentions if m['choice_id'] == 'present']
 
 
+def mentions_summary(mentions):
+    """Returns noted mentions as text."""
+    return "Noting: {}".format(", ".join(mention_as_text(m) for m in mentions))
+
+
 def summarise_mentions(mentions):
     """Prints noted mentions."""
-    print("Noting: {}".format(", ".join(mention_as_text(m) for m in mentions)))
+    print(mentions_summary(mentions))
 
 
-def read_complaints(age, sex, auth_string, case_id, language_model=None):
+def read_complaints(age, sex, auth_string, case_id, language_model=None,
+                    pipelined=False):
     """Keeps reading complaint-describing messages from user until empty
     message is read (or just read the story if given). Will call the /parse
     endpoint and return mentions captured there.
@@ -117,11 +205,16 @@ def read_complaints(age, sex, auth_string, case_id, language_model=None):
         auth_string (str): Authentication string.
         case_id (str): Case ID.
         lanugage_model (str): Chosen language model.
+        pipelined (bool): Read the next message while the previous ones are
+            still being parsed (the mentions are the same).
 
     Returns:
         list: Mentions extracted from user answers.
 
     """
+    if pipelined:
+        return _read_complaints_pipelined(age, sex, auth_string, case_id,
+                                          language_model)
     mentions = []
     context = []  # List of ids of present symptoms in the order of reporting.
     while True:
@@ -138,38 +231,302 @@ def read_complaints(age, sex, auth_string, case_id, language_model=None):
             return mentions
 
 
+def _read_complaints_pipelined(age, sex, auth_string, case_id,
+                               language_model):
+    """read_complaints that sends each message to /parse in the background.
+
+    Each message is parsed with the context known when it was typed (what
+    the earlier messages were understood as so far). Results are taken in
+    order; a message sent before the earlier ones were understood is parsed
+    again if the context turned out different, so the mentions are exactly
+    those of read_complaints.
+    """
+    executor = _get_parse_executor()
+    mentions = []
+    context = []  # ids of present complaints of the messages merged so far
+    pending = collections.deque()  # [text, context sent, future] in order
+
+    def parse(text):
+        _count_intake('parses')
+        return list(context), executor.submit(
+            localparse.parse, age, sex, text, auth_string, case_id,
+            list(context), language_model=language_model)
+
+    def merge(wait):
+        while pending:
+            text, sent_context, future = pending[0]
+            if sent_context != context:
+                # The earlier messages changed the context since this one was
+                # sent, parse it again (the stale result is ignored).
+                _count_intake('reparses')
+                pending[0][1:] = parse(text)
+                future = pending[0][2]
+            if not wait and not future.done():
+                return
+            pending.popleft()
+            portion = future.result()
+            if portion:
+                summarise_mentions(portion)
+                mentions.extend(portion)
+                context.extend(context_from_mentions(portion))
+
+    while True:
+        text = read_input(COMPLAINTS_PROMPT)
+        # parses that finished while the user was typing give the context
+        merge(wait=False)
+        if text:
+            pending.append([text, *parse(text)])
+            continue
+        merge(wait=True)
+        if mentions:
+            return mentions
+
+
 def read_single_question_answer(question_text):
     """Primitive implementation of understanding user's answer to a
     single-choice question. Prompt the user with question text, read user's
     input and convert it to one of the expected evidence statuses: present,
     absent or unknown. Return None if no answer provided."""
-    answer = read_input(question_text)
-    if not answer:
-        return None
+    while True:
+        answer = read_input(question_text)
+        if not answer:
+            return None
 
-    try:
-        return extract_decision(answer, constants.ANSWER_NORM)
-    except (AmbiguousAnswerException, ValueError) as e:
-        print("{} Please repeat.".format(e))
-        return read_single_question_answer(question_text)
+        try:
+            return extract_decision(answer, constants.ANSWER_NORM)
+        except (AmbiguousAnswerException, ValueError) as e:
+            print("{} Please repeat.".format(e))
+
+
+def ask_group_items(question_struct, answer_item):
+    """Asks for the items of a group question one by one. Items of a
+    "group_single" question are only asked until one is chosen.
+
+    Args:
+        question_struct (dict): Group question from /diagnosis.
+        answer_item (callable): Function returning the observation value
+            (or None for no answer) given the question item.
+
+    Returns:
+        dict: Observation values keyed by ids of the items answered.
+
+    """
+    observation_values = {}
+    for item in question_struct['items']:
+        observation_value = answer_item(item)
+        if observation_value is None:
+            continue
+        observation_values[item['id']] = observation_value
+        if (question_struct['type'] == 'group_single'
+                and observation_value == 'present'):
+            break
+    return observation_values
+
+
+def _named_decisions(text, items):
+    """Returns the decisions about the items named in the reply, keyed by
+    item ids. Each clause naming items decides about them: "present" unless
+    it says otherwise (e.g. "no cough but fever").
+
+    Raises:
+        AmbiguousAnswerException: If a clause gives conflicting decisions,
+            or a decision without naming an item while other clauses do.
 
+    """
+    matcher = keywordmatch.KeywordMatcher([item['name'] for item in items])
+    ids = {item['name'].lower(): item['id'] for item in items}
+    decisions = {}
+    stray = False
+    for clause in localparse.split_clauses(text):
+        names = matcher.findall(clause)
+        rest = clause.lower()
+        for name in names:
+            rest = rest.replace(name.lower(), ' ')
+        found = {_GROUP_DECISION_NORM[keyword] for keyword
+                 in extract_keywords(rest, _GROUP_DECISION_NORM)}
+        if not names:
+            stray = stray or bool(found)
+            continue
+        if len(found) > 1:
+            raise AmbiguousAnswerException("The answer seemed ambiguous.")
+        decision = found.pop() if found else 'present'
+        for name in names:
+            if decisions.setdefault(ids[name.lower()], decision) != decision:
+                raise AmbiguousAnswerException(
+                    "The answer seemed ambiguous.")
+    if decisions and stray:
+        raise AmbiguousAnswerException("The answer seemed ambiguous.")
+    return decisions
+
+
+def parse_group_answer(text, question_struct):
+    """Understands a reply to a whole group question.
+
+    The reply may name the items, each one present unless negated in its
+    clause (e.g. "no cough but fever"), or give just the numbers of the
+    items that apply; once some items are said to apply, the rest are
+    absent. It may also give a decision for each item in order
+    (group_multiple only; e.g. "yes, no, don't know") or a single decision
+    for all of them (for group_single only "no" or "don't know").
+
+    Args:
+        text (str): User message.
+        question_struct (dict): Group question.
+
+    Returns:
+        dict: Observation values keyed by ids of the items answered.
+
+    Raises:
+        AmbiguousAnswerException: If the reply doesn't fit the question.
+        ValueError: If the reply says nothing about the items.
 
-def conduct_interview(evidence, age, sex, case_id, auth, language_model=None):
+    """
+    items = question_struct['items']
+    single = question_struct['type'] == 'group_single'
+    decisions = _named_decisions(text, items)
+    if not decisions and _NUMBER_LIST_REGEX.fullmatch(text):
+        numbers = [int(number) for number in _NUMBER_REGEX.findall(text)]
+        if any(number < 1 or number > len(items) for number in numbers):
+            raise ValueError("Please give numbers from 1 to {}."
+                             .format(len(items)))
+        decisions = {items[number - 1]['id']: 'present'
+                     for number in numbers}
+    if decisions:
+        chosen = [item_id for item_id, decision in decisions.items()
+                  if decision == 'present']
+        if single and len(chosen) > 1:
+            raise AmbiguousAnswerException("Please choose one answer.")
+        if not chosen:
+            return decisions
+        return {item['id']: decisions.get(item['id'], 'absent')
+                for item in items}
+    decisions = [constants.ANSWER_NORM[keyword] for keyword
+                 in extract_keywords(text, constants.ANSWER_NORM)]
+    if not decisions:
+        raise ValueError("No decision found.")
+    if len(set(decisions)) == 1 and not (single and
+                                         decisions[0] == 'present'):
+        return {item['id']: decisions[0] for item in items}
+    if not single and len(decisions) == len(items):
+        return {item['id']: decision
+                for item, decision in zip(items, decisions)}
+    raise AmbiguousAnswerException("The answer seemed ambiguous.")
+
+
+def question_prompt(question_struct):
+    """Returns the text presenting the question to the user (with numbered
+    items if it's a group question)."""
+    if question_struct['type'] == 'single':
+        return question_struct['text']
+    lines = [question_struct['text']]
+    for idx, item in enumerate(question_struct['items']):
+        lines.append('{:2}. {}'.format(idx + 1, item['name']))
+    lines.append(GROUP_SINGLE_PROMPT
+                 if question_struct['type'] == 'group_single'
+                 else GROUP_MULTIPLE_PROMPT)
+    return '\n'.join(lines)
+
+
+def is_near_stop(diagnoses):
+    """Tells whether the leading diagnosis is likely enough for the interview
+    to be about to finish."""
+    return bool(diagnoses) and (diagnoses[0]['probability']
+                                >= constants.TRIAGE_PREFETCH_PROBABILITY)
+
+
+def diagnose(evidence, age, sex, case_id, auth, language_model=None,
+             prefetch_triage=False, no_groups=True):
+    """Calls /diagnosis with the evidence gathered so far and, if the
+    diagnostic engine says it's time to stop, /triage as well.
+
+    Args:
+        evidence (evidencestore.EvidenceStore): Evidence gathered so far
+            (a list of dicts will do too).
+        age (dict): Patients age in {'value': int, 'unit': str} format.
+        sex (str): Patients sex.
+        case_id (str): Case ID.
+        auth (str): Authentication string.
+        language_model (str): Chosen language model.
+        prefetch_triage (bool): Call /triage in parallel with /diagnosis
+            instead of waiting for the stop signal (see
+            triage_prefetch_stats).
+        no_groups (bool): Ask /diagnosis for single questions only.
+
+    Returns:
+        dict, dict: Response from /diagnosis and response from /triage (None
+            unless the interview should stop now).
+
+    """
+    triage_future = None
+    if prefetch_triage:
+        _count_prefetch('calls')
+        triage_future = _get_prefetch_executor().submit(
+            apiaccess.call_triage, evidence.copy(), age, sex, case_id,
+            auth, language_model=language_model)
+    resp = apiaccess.call_diagnosis(evidence, age, sex, case_id, auth,
+                                    no_groups=no_groups,
+                                    language_model=language_model)
+    if resp['should_stop']:
+        # Triage recommendation must be obtained from a separate endpoint,
+        # call it now (unless already called for the same evidence) and
+        # return all the information together.
+        if triage_future is not None:
+            _count_prefetch('hits')
+            return resp, triage_future.result()
+        return resp, apiaccess.call_triage(evidence, age, sex, case_id, auth,
+                                           language_model=language_model)
+    if triage_future is not None:
+        _count_prefetch('wasted')
+        if triage_future.cancel():
+            _count_prefetch('cancelled')
+    return resp, None
+
+
+def conduct_interview(evidence, age, sex, case_id, auth, language_model=None,
+                      prefetch_triage=None, answer_question=None,
+                      max_questions=None, no_groups=True):
     """Keep asking questions until API tells us to stop or the user gives an
-    empty answer."""
+    empty answer.
+
+    Set prefetch_triage to "always" or "near_stop" to call /triage in parallel
+    with /diagnosis (on every turn or only once the interview seems to be
+    close to the end respectively). This saves one round trip when the stop
+    is signalled, at the expense of some discarded /triage calls (see
+    triage_prefetch_stats).
+
+    Set no_groups to False to get group questions too; their items are
+    asked one by one and all the answers are sent to /diagnosis at once,
+    which takes fewer round trips than a single question per item.
+
+    Questions are put to the user unless answer_question is given: a
+    function called with the question item and text that returns the
+    observation value (or None for no answer). With max_questions the
+    interview is cut short after that many questions, with the triage for
+    the evidence gathered so far.
+
+    The evidence (a list of dicts or an evidencestore.EvidenceStore) is
+    returned as an EvidenceStore, a repeated answer replacing the earlier
+    one."""
+    if not isinstance(evidence, evidencestore.EvidenceStore):
+        evidence = evidencestore.EvidenceStore(evidence)
+    prefetch_now = prefetch_triage == 'always'
+    questions = 0
     while True:
-        resp = apiaccess.call_diagnosis(evidence, age, sex, case_id, auth,
-                                        language_model=language_model)
+        resp, triage_resp = diagnose(evidence, age, sex, case_id, auth,
+                                     language_model=language_model,
+                                     prefetch_triage=prefetch_now,
+                                     no_groups=no_groups)
         question_struct = resp['question']
         diagnoses = resp['conditions']
-        should_stop_now = resp['should_stop']
-        if should_stop_now:
-            # Triage recommendation must be obtained from a separate endpoint,
-            # call it now and return all the information together.
-            triage_resp = apiaccess.call_triage(evidence, age, sex, case_id,
-                                                auth,
-                                                language_model=language_model)
+        if triage_resp is None and questions == max_questions:
+            triage_resp = apiaccess.call_triage(
+                evidence, age, sex, case_id, auth,
+                language_model=language_model)
+        if triage_resp is not None:
             return evidence, diagnoses, triage_resp
+        questions += 1
+        if prefetch_triage == 'near_stop':
+            prefetch_now = is_near_stop(diagnoses)
         new_evidence = []
         if question_struct['type'] == 'single':
             # If you're calling /diagnosis in "disable_groups" mode, you'll
@@ -179,62 +536,309 @@ def conduct_interview(evidence, age, sex, case_id, auth, language_model=None):
             question_items = question_struct['items']
             assert len(question_items) == 1  # this is a single question
             question_item = question_items[0]
-            observation_value = read_single_question_answer(
-                question_text=question_struct['text'])
+            if answer_question is None:
+                observation_value = read_single_question_answer(
+                    question_text=question_struct['text'])
+            else:
+                observation_value = answer_question(question_item,
+                                                    question_struct['text'])
             if observation_value is not None:
                 new_evidence.extend(apiaccess.question_answer_to_evidence(
                     question_item, observation_value))
         else:
-            # You'd need a rich UI to handle group questions gracefully.
             # There are two types of group questions: "group_single" (radio
             # buttons) and "group_multiple" (a bunch of single questions
-            # gathered under one caption). Actually you can try asking
-            # sequentially for each question item from "group_multiple"
-            # question and then adding the evidence coming from all these
-            # answers. For "group_single" there should be only one present
-            # answer. It's recommended to include only this chosen answer as
-            # present symptom in the new evidence. For more details, please
-            # consult:
-            # https://developer.infermedica.com/docs/diagnosis#group_single
-            raise NotImplementedError("Group questions not handled in this"
-                                      "example")
+            # gathered under one caption). Without a rich UI, we ask
+            # sequentially for each question item and then add the evidence
+            # coming from all these answers. For "group_single" there should
+            # be only one present answer, so we stop asking once it's given
+            # (see apiaccess.group_answers_to_evidence).
+            if answer_question is None:
+                print(question_struct['text'])
+
+                def answer_item(item):
+                    return read_single_question_answer(
+                        question_text=item['name'] + '?')
+            else:
+                def answer_item(item):
+                    return answer_question(item, question_struct['text'])
+            new_evidence.extend(apiaccess.group_answers_to_evidence(
+                question_struct, ask_group_items(question_struct,
+                                                 answer_item)))
         # Important: always update the evidence gathered so far with the new
         # answers
         evidence.extend(new_evidence)
 
 
-def summarise_some_evidence(evidence, header):
-    print(header + ':')
+class InterviewState:
+    """State of one conversation, advanced one user message at a time by
+    step() instead of being kept on the stack of the read_* loops. It's small
+    and can be serialised (see dumps), so that idle conversations may be
+    parked or passed to another worker.
+
+    Attributes:
+        case_id (str): Case ID.
+        stage (str): "age_sex", "complaints", "interview" or "finished".
+        age (int): Patients age in years (None until known).
+        sex (str): Patients sex (None until known).
+        evidence (evidencestore.EvidenceStore): Evidence gathered so far,
+            complaints included.
+        context (list): IDs of present complaints in the order of reporting.
+        question (dict): Last question asked ("type", "text" and "items",
+            each item reduced to "id" and "name").
+        prefetch_triage (bool): Whether /triage is to be called along with
+            the next /diagnosis.
+
+    """
+
+    __slots__ = ('case_id', 'stage', 'age', 'sex', 'evidence', 'context',
+                 'question', 'prefetch_triage')
+
+    def __init__(self, case_id, stage='age_sex', age=None, sex=None,
+                 evidence=None, context=None, question=None,
+                 prefetch_triage=False):
+        self.case_id = case_id
+        self.stage = stage
+        self.age = age
+        self.sex = sex
+        if not isinstance(evidence, evidencestore.EvidenceStore):
+            evidence = evidencestore.EvidenceStore(evidence or ())
+        self.evidence = evidence
+        self.context = context if context is not None else []
+        self.question = question
+        self.prefetch_triage = prefetch_triage
+
+    @property
+    def api_age(self):
+        """Age in the format expected by the API."""
+        return {'value': self.age, 'unit': 'year'}
+
+    def dumps(self):
+        """Serialises the state to a compact JSON blob.
+
+        Returns:
+            bytes: Serialised state.
+
+        """
+        content = [constants.STATE_FORMAT_VERSION, self.case_id, self.stage,
+                   self.age, self.sex, self.evidence.to_rows(), self.context,
+                   self.question, self.prefetch_triage]
+        return json.dumps(content, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def loads(cls, blob):
+        """Restores the state serialised by dumps.
+
+        Args:
+            blob (bytes): Serialised state.
+
+        Returns:
+            InterviewState: Restored state.
+
+        Raises:
+            ValueError: If the blob is not a serialised state.
+
+        """
+        content = json.loads(blob)
+        if not content or content[0] != constants.STATE_FORMAT_VERSION:
+            raise ValueError("Unsupported state format.")
+        (_, case_id, stage, age, sex, evidence, context, question,
+         prefetch_triage) = content
+        return cls(case_id, stage, age, sex,
+                   evidencestore.EvidenceStore.from_rows(evidence), context,
+                   question, prefetch_triage)
+
+    @property
+    def finished(self):
+        return self.stage == 'finished'
+
+
+def start(state):
+    """Returns the opening messages of a conversation.
+
+    Args:
+        state (InterviewState): New conversation state.
+
+    Returns:
+        list: Messages to be displayed to the user.
+
+    """
+    return [AGE_SEX_PROMPT]
+
+
+def step(state, text, auth_string, language_model=None,
+         prefetch_triage=None, no_groups=True):
+    """Advances the conversation with one user message.
+
+    Args:
+        state (InterviewState): Conversation state (updated in place).
+        text (str): User message.
+        auth_string (str): Authentication string.
+        language_model (str): Chosen language model.
+        prefetch_triage (str): Triage prefetch mode (see conduct_interview).
+        no_groups (bool): Ask single questions only (see conduct_interview).
+            A group question is answered with one message (see
+            parse_group_answer).
+
+    Returns:
+        list: Messages to be displayed to the user.
+
+    """
+    handler = _STEP_HANDLERS[state.stage]
+    return handler(state, text.strip(), auth_string, language_model,
+                   prefetch_triage, no_groups)
+
+
+def _step_age_sex(state, text, auth_string, language_model, prefetch_triage,
+                  no_groups):
+    try:
+        state.age, state.sex = parse_age_sex(text)
+    except (AmbiguousAnswerException, ValueError) as e:
+        return ["{} Please repeat.".format(e), AGE_SEX_PROMPT]
+    state.stage = 'complaints'
+    return ["Ok, {} year old {}.".format(state.age, state.sex),
+            COMPLAINTS_PROMPT]
+
+
+def _step_complaints(state, text, auth_string, language_model,
+                     prefetch_triage, no_groups):
+    if not text:
+        if not state.evidence:
+            return [COMPLAINTS_PROMPT]
+        state.prefetch_triage = prefetch_triage == 'always'
+        messages = _next_question(state, auth_string, language_model,
+                                  prefetch_triage, no_groups)
+        # only once there's a question (or the results), so that a failed
+        # call leaves the user where they were
+        if state.stage == 'complaints':
+            state.stage = 'interview'
+        return messages
+    portion = localparse.parse(state.api_age, state.sex, text, auth_string,
+                               state.case_id, state.context,
+                               language_model=language_model)
+    messages = []
+    if portion:
+        messages.append(mentions_summary(portion))
+        state.evidence.extend(apiaccess.mentions_to_evidence(portion))
+        state.context.extend(context_from_mentions(portion))
+    messages.append(COMPLAINTS_PROMPT)
+    return messages
+
+
+def _step_interview(state, text, auth_string, language_model,
+                    prefetch_triage, no_groups):
+    # without a question (its call failed) the message can't be an answer
+    if text and state.question is not None:
+        question = state.question
+        try:
+            if question['type'] == 'single':
+                new_evidence = apiaccess.question_answer_to_evidence(
+                    question['items'][0],
+                    extract_decision(text, constants.ANSWER_NORM))
+            else:
+                new_evidence = apiaccess.group_answers_to_evidence(
+                    question, parse_group_answer(text, question))
+        except (AmbiguousAnswerException, ValueError) as e:
+            return ["{} Please repeat.".format(e), question_prompt(question)]
+        state.evidence.extend(new_evidence)
+    return _next_question(state, auth_string, language_model, prefetch_triage,
+                          no_groups)
+
+
+def _step_finished(state, text, auth_string, language_model,
+                   prefetch_triage, no_groups):
+    return []
+
+
+_STEP_HANDLERS = {
+    'age_sex': _step_age_sex,
+    'complaints': _step_complaints,
+    'interview': _step_interview,
+    'finished': _step_finished,
+}
+
+
+def _next_question(state, auth_string, language_model, prefetch_triage,
+                   no_groups):
+    """Asks /diagnosis for the next question or finishes the interview."""
+    resp, triage_resp = diagnose(state.evidence, state.api_age, state.sex,
+                                 state.case_id, auth_string,
+                                 language_model=language_model,
+                                 prefetch_triage=state.prefetch_triage,
+                                 no_groups=no_groups)
+    diagnoses = resp['conditions']
+    if triage_resp is not None:
+        state.stage = 'finished'
+        state.question = None
+        naming = catalog.get_naming(state.api_age, auth_string, state.case_id,
+                                    language_model)
+        apiaccess.name_evidence(state.evidence, naming)
+        return [all_evidence_summary(state.evidence),
+                diagnoses_summary(diagnoses),
+                triage_summary(triage_resp)]
+    if prefetch_triage == 'near_stop':
+        state.prefetch_triage = is_near_stop(diagnoses)
+    question_struct = resp['question']
+    state.question = {
+        'type': question_struct['type'],
+        'text': question_struct['text'],
+        'items': [{'id': item['id'], 'name': item['name']}
+                  for item in question_struct['items']]}
+    return [question_prompt(state.question)]
+
+
+def some_evidence_summary(evidence, header):
+    lines = [header + ':']
     for idx, piece in enumerate(evidence):
-        print('{:2}. {}'.format(idx + 1, mention_as_text(piece)))
-    print()
+        lines.append('{:2}. {}'.format(idx + 1, mention_as_text(piece)))
+    return '\n'.join(lines) + '\n'
 
 
-def summarise_all_evidence(evidence):
+def all_evidence_summary(evidence):
+    if isinstance(evidence, evidencestore.EvidenceStore):
+        evidence = evidence.as_dicts()
     reported = []
     answered = []
     for piece in evidence:
-        (reported if piece.get('initial') else answered).append(piece)
-    summarise_some_evidence(reported, 'Patient complaints')
-    summarise_some_evidence(answered, 'Patient answers')
+        (reported if piece.get('source') == 'initial' else answered).append(
+            piece)
+    return '\n'.join([some_evidence_summary(reported, 'Patient complaints'),
+                      some_evidence_summary(answered, 'Patient answers')])
 
 
-def summarise_diagnoses(diagnoses):
-    print('Diagnoses:')
+def diagnoses_summary(diagnoses):
+    lines = ['Diagnoses:']
     for idx, diag in enumerate(diagnoses):
-        print('{:2}. {:.2f} {}'.format(idx + 1, diag['probability'],
-                                       diag['name']))
-    print()
+        lines.append('{:2}. {:.2f} {}'.format(idx + 1, diag['probability'],
+                                              diag['name']))
+    return '\n'.join(lines) + '\n'
 
 
-def summarise_triage(triage_resp):
-    print('Triage level: {}'.format(triage_resp['triage_level']))
+def triage_summary(triage_resp):
+    lines = ['Triage level: {}'.format(triage_resp['triage_level'])]
     teleconsultation_applicable = triage_resp.get(
         'teleconsultation_applicable')
     if teleconsultation_applicable is not None:
-        print('Teleconsultation applicable: {}'
-              .format(teleconsultation_applicable))
-    print()
+        lines.append('Teleconsultation applicable: {}'
+                     .format(teleconsultation_applicable))
+    return '\n'.join(lines) + '\n'
+
+
+def summarise_some_evidence(evidence, header):
+    print(some_evidence_summary(evidence, header))
+
+
+def summarise_all_evidence(evidence):
+    print(all_evidence_summary(evidence))
+
+
+def summarise_diagnoses(diagnoses):
+    print(diagnoses_summary(diagnoses))
+
+
+def summarise_triage(triage_resp):
+    print(triage_summary(triage_resp))
 
 
 def extract_keywords(text, keywords):
@@ -242,19 +846,14 @@ def extract_keywords(text, keywords):
 
     Args:
         text (str): Text from which the keywords will be extracted.
-        keywords (list): Keywords to look for.
+        keywords (list): Keywords to look for. The matcher built for them is
+            cached, so pass the same (unmodified) collection each time.
 
     Returns:
         list: All keywords found in text.
 
     """
-    # Construct an alternative regex pattern for each keyword (speeds up the
-    # search). Note that keywords must me escaped as they could potentialy
-    # contain regex-specific symbols, e.g. ?, *.
-    pattern = r"|".join(r"\b{}\b".format(re.escape(keyword))
-                        for keyword in keywords)
-    mentions_regex = re.compile(pattern, flags=re.I)
-    return mentions_regex.findall(text)
+    return keywordmatch.get_matcher(keywords).findall(text)
 
 
 def extract_decision(text, mapping):
@@ -273,9 +872,9 @@ def extract_decision(text, mapping):
         ValueError: If no keywords can be found in `text`.
 
     """
-    decision_keywrods = set(extract_keywords(text, mapping.keys()))
+    decision_keywrods = set(extract_keywords(text, mapping))
     if len(decision_keywrods) == 1:
-        return mapping[decision_keywrods.pop().lower()]
+        return mapping[decision_keywrods.pop()]
     elif len(decision_keywrods) > 1:
         raise AmbiguousAnswerException("The decision seemed ambiguous.")
     else:
@@ -298,9 +897,9 @@ def extract_sex(text, mapping):
         ValueError: If no keywords can be found in `text`.
 
     """
-    sex_keywords = set(extract_keywords(text, mapping.keys()))
+    sex_keywords = set(extract_keywords(text, mapping))
     if len(sex_keywords) == 1:
-        return mapping[sex_keywords.pop().lower()]
+        return mapping[sex_keywords.pop()]
     elif len(sex_keywords) > 1:
         raise AmbiguousAnswerException("I understood multiple sexes.")
     else:
@@ -321,7 +920,7 @@ def extract_age(text):
         ValueError: If no numbers can be found in `text`.
 
     """
-    ages = set(re.findall(r"\b\d+\b", text))
+    ages = set(_NUMBER_REGEX.findall(text))
     if len(ages) == 1:
         return ages.pop()
     elif len(ages) > 1:
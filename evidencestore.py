@@ -0,0 +1,182 @@
+"""Compact evidence of an interview.
+
+Evidence is what the API is told about the patient: observation ids with
+their status ("choice_id") and, for the complaints, their "source". Sessions
+keep it in an EvidenceStore rather than a list of dicts:
+
+* each distinct piece of evidence is a single immutable Piece shared by all
+  the sessions in the process, which also holds its request JSON and digest,
+  so a session only keeps references to them;
+* there's at most one piece per observation; a repeated answer replaces the
+  previous one in place (O(1));
+* the digest of the whole evidence (used in cache keys) is maintained as
+  pieces come and go, and doesn't depend on their order;
+* the request JSON is joined from the pre-encoded pieces.
+"""
+import collections.abc
+import hashlib
+import json
+import sys
+import threading
+
+import constants
+
+
+class Piece(collections.abc.Mapping):
+    """One piece of evidence. Reads like the dict sent to the API ("id",
+    "choice_id" and optionally "source"). Use piece() to obtain one."""
+
+    __slots__ = ('id', 'choice_id', 'source', 'json', 'digest')
+    _FIELDS = ('id', 'choice_id', 'source')
+
+    def __init__(self, obs_id, choice_id, source=None):
+        self.id = sys.intern(obs_id)
+        self.choice_id = sys.intern(choice_id)
+        self.source = sys.intern(source) if source is not None else None
+        fields = {'id': obs_id, 'choice_id': choice_id}
+        if source is not None:
+            fields['source'] = source
+        self.json = json.dumps(fields, separators=(',', ':'))
+        self.digest = int.from_bytes(hashlib.blake2b(
+            self.json.encode('utf-8'), digest_size=16).digest(), 'big')
+
+    def __getitem__(self, field):
+        value = getattr(self, field, None) if field in self._FIELDS else None
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __iter__(self):
+        return (field for field in self._FIELDS
+                if getattr(self, field) is not None)
+
+    def __len__(self):
+        return 2 if self.source is None else 3
+
+    def __repr__(self):
+        return 'Piece({})'.format(self.json)
+
+
+_pieces = {}  # (id, choice_id, source) -> Piece
+_pieces_lock = threading.Lock()
+
+
+def piece(obs_id, choice_id, source=None):
+    """Returns the shared Piece with the given content."""
+    key = (obs_id, choice_id, source)
+    found = _pieces.get(key)
+    if found is None:
+        found = Piece(obs_id, choice_id, source)
+        with _pieces_lock:
+            if len(_pieces) < constants.EVIDENCE_PIECES_MAX:
+                found = _pieces.setdefault(key, found)
+    return found
+
+
+class EvidenceStore(collections.abc.Sequence):
+    """Evidence gathered so far, one piece per observation, in the order of
+    first reporting.
+
+    Args:
+        pieces (iterable): Initial evidence (dicts or pieces).
+
+    Attributes:
+        naming (Mapping): Observation names used by as_dicts (see
+            apiaccess.name_evidence).
+
+    """
+
+    __slots__ = ('_pieces', '_positions', '_digest', 'naming')
+
+    def __init__(self, pieces=()):
+        self._pieces = []
+        self._positions = {}  # observation id -> index in _pieces
+        self._digest = 0
+        self.naming = None
+        self.extend(pieces)
+
+    def __getitem__(self, idx):
+        return self._pieces[idx]
+
+    def __len__(self):
+        return len(self._pieces)
+
+    def __repr__(self):
+        return 'EvidenceStore({})'.format(self.to_json())
+
+    def add(self, obs_id, choice_id, source=None):
+        """Adds a piece of evidence, replacing the one about the same
+        observation, if any."""
+        new = piece(obs_id, choice_id, source)
+        idx = self._positions.get(new.id)
+        if idx is None:
+            self._positions[new.id] = len(self._pieces)
+            self._pieces.append(new)
+            self._digest ^= new.digest
+            return
+        old = self._pieces[idx]
+        if old is not new:
+            self._pieces[idx] = new
+            self._digest ^= old.digest ^ new.digest
+
+    def append(self, item):
+        self.add(item['id'], item['choice_id'], item.get('source'))
+
+    def extend(self, items):
+        for item in items:
+            self.add(item['id'], item['choice_id'], item.get('source'))
+
+    def copy(self):
+        """Returns an independent store with the same evidence (pieces are
+        shared, they're immutable)."""
+        other = EvidenceStore.__new__(EvidenceStore)
+        other._pieces = list(self._pieces)
+        other._positions = dict(self._positions)
+        other._digest = self._digest
+        other.naming = self.naming
+        return other
+
+    def footprint(self):
+        """Returns the approximate number of bytes held by the store (the
+        shared pieces and naming not counted)."""
+        return (sys.getsizeof(self) + sys.getsizeof(self._pieces)
+                + sys.getsizeof(self._positions))
+
+    def digest(self):
+        """Returns an order-independent digest of the evidence (hex str)."""
+        return '{:032x}'.format(self._digest)
+
+    def to_json(self):
+        """Returns the evidence encoded as the JSON array expected by the
+        API."""
+        return '[' + ','.join(item.json for item in self._pieces) + ']'
+
+    def to_rows(self):
+        """Returns the evidence as [id, choice_id, source] lists."""
+        return [[item.id, item.choice_id, item.source]
+                for item in self._pieces]
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Restores the evidence from to_rows output."""
+        store = cls()
+        for obs_id, choice_id, source in rows:
+            store.add(obs_id, choice_id, source)
+        return store
+
+    def as_dicts(self):
+        """Returns the evidence as a list of dicts, with names if naming is
+        set."""
+        dicts = [dict(item) for item in self._pieces]
+        if self.naming is not None:
+            for item in dicts:
+                item['name'] = self.naming[item['id']]
+        return dicts
+
+
+def digest(evidence):
+    """Returns the digest of the evidence given as a store or a list of
+    dicts (see EvidenceStore.digest)."""
+    if not isinstance(evidence, EvidenceStore):
+        evidence = EvidenceStore(evidence)
+    return evidence.digest()
@@ -0,0 +1,137 @@
+"""Decoding of the JSON bodies of API responses.
+
+Bodies are decoded with orjson when it's installed (it's several times faster
+than the json module), with json otherwise. A projection says which fields of
+a response are actually needed (see project): large responses can then be
+decoded incrementally, as they are being downloaded, one array item or object
+member at a time, keeping only the projected fields, so the whole document is
+never held in memory.
+"""
+import codecs
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKEND = 'json' if orjson is None else 'orjson'
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_CLOSING = {'[': ']', '{': '}'}
+_DELIMITERS = frozenset(' \t\n\r,:]}')
+_decoder = json.JSONDecoder()
+
+
+def loads(data):
+    """Decodes a JSON document (bytes or str) with the fastest backend."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def project(value, spec):
+    """Returns the value reduced to the fields given by the spec.
+
+    A spec of None keeps the whole value. A collection of field names keeps
+    those fields of an object; a dict maps field names to specs of the
+    values. Specs of objects apply to each item of an array. Missing fields
+    are left out.
+
+    Example:
+        {'question': None, 'conditions': ('id', 'probability')} keeps the
+        whole "question" and only "id" and "probability" of each condition.
+
+    """
+    if spec is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, spec) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if isinstance(spec, dict):
+        return {field: project(value[field], field_spec)
+                for field, field_spec in spec.items() if field in value}
+    return {field: value[field] for field in spec if field in value}
+
+
+def iter_members(chunks):
+    """Decodes a JSON array or object given as a sequence of byte chunks,
+    yielding its parts as soon as they're complete.
+
+    Yields:
+        First "[" or "{" (the kind of the document), then (None, item) for
+        each array item or (key, value) for each object member.
+
+    Raises:
+        ValueError: If the document is not a well-formed array or object.
+
+    """
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf, pos = '', 0
+    container = key = None
+    expect = 'start'  # start, open, element, colon, value or after
+    eof = False
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos < len(buf):
+            char = buf[pos]
+            if expect == 'start':
+                if char not in _CLOSING:
+                    raise ValueError('JSON array or object expected')
+                container = char
+                yield char
+                expect = 'open'
+                pos += 1
+                continue
+            if char == _CLOSING[container] and expect in ('open', 'after'):
+                return
+            if expect in ('after', 'colon'):
+                if char != (',' if expect == 'after' else ':'):
+                    raise ValueError('malformed JSON at {!r}'.format(char))
+                expect = 'element' if expect == 'after' else 'value'
+                pos += 1
+                continue
+            try:
+                item, end = _decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None  # incomplete, read on
+            # the item is certainly complete only if a delimiter follows it
+            # (a number cut at "-2." decodes as -2)
+            if end is not None and (eof or (end < len(buf)
+                                            and buf[end] in _DELIMITERS)):
+                pos = end
+                if container == '{' and expect != 'value':
+                    if not isinstance(item, str):
+                        raise ValueError('JSON object key expected')
+                    key = item
+                    expect = 'colon'
+                else:
+                    yield key, item
+                    expect = 'after'
+                continue
+        if eof:
+            raise ValueError('truncated JSON')
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            chunk = text_decoder.decode(b'', final=True)
+        else:
+            chunk = text_decoder.decode(chunk)
+        buf, pos = buf[pos:] + chunk, 0
+
+
+def decode_chunks(chunks, spec):
+    """Decodes the JSON array or object given as a sequence of byte chunks
+    incrementally, building only the fields given by the spec (see
+    project; spec of an object must name its fields)."""
+    members = iter_members(chunks)
+    if next(members) == '[':
+        return [project(item, spec) for _, item in members]
+    if not isinstance(spec, dict):
+        spec = dict.fromkeys(spec)
+    return {key: project(value, spec[key]) for key, value in members
+            if key in spec}
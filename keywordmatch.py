@@ -0,0 +1,119 @@
+"""Keyword matching used to understand short user answers.
+
+A matcher is built once for a given set of keywords (e.g. constants.SEX_NORM)
+and reused for every message. The keywords are kept in a character trie, so
+the cost of searching a message hardly depends on the number of keywords and
+nothing gets compiled per message.
+"""
+
+_END = object()  # trie key marking the end of a keyword
+
+_matchers = {}  # id(keywords) -> (keywords, matcher)
+_MAX_MATCHERS = 64
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class KeywordMatcher:
+    """Finds whole-word, case-insensitive occurrences of keywords in text.
+
+    Keyword edges being word characters must not be adjacent to other word
+    characters (so "n" is not found in "no"); edges such as "?" may be
+    adjacent to anything. Overlapping occurrences are resolved in favour of the
+    one that starts first and then the longest one (so "no lo sé" wins over
+    "no").
+
+    Args:
+        keywords (iterable): Keywords to look for.
+
+    """
+
+    def __init__(self, keywords):
+        self._trie = {}
+        for keyword in keywords:
+            if not keyword:
+                continue
+            node = self._trie
+            for char in keyword.lower():
+                node = node.setdefault(char, {})
+            node[_END] = keyword
+
+    def findall(self, text):
+        """Finds keywords in text.
+
+        Args:
+            text (str): Text to search.
+
+        Returns:
+            list: Keywords found (as given to the matcher), in order of
+                occurrence.
+
+        """
+        text = text.lower()
+        found = []
+        pos = 0
+        while pos < len(text):
+            match = self._match_at(text, pos)
+            if match is None:
+                pos += 1
+            else:
+                keyword, pos = match
+                found.append(keyword)
+        return found
+
+    def findall_many(self, texts):
+        """Finds keywords in each of the texts.
+
+        Args:
+            texts (iterable): Texts to search.
+
+        Returns:
+            list: List of keywords found for each text.
+
+        """
+        return [self.findall(text) for text in texts]
+
+    def _match_at(self, text, start):
+        """Returns the longest keyword occurring at start along with the
+        position right after it, or None."""
+        before_is_word = start > 0 and _is_word_char(text[start - 1])
+        if before_is_word and _is_word_char(text[start]):
+            return None
+        longest = None
+        node = self._trie
+        pos = start
+        while pos < len(text):
+            node = node.get(text[pos])
+            if node is None:
+                break
+            pos += 1
+            keyword = node.get(_END)
+            if keyword is not None and not (
+                    _is_word_char(text[pos - 1]) and pos < len(text)
+                    and _is_word_char(text[pos])):
+                longest = keyword, pos
+        return longest
+
+
+def get_matcher(keywords):
+    """Returns a matcher for the given keywords, building it only once for
+    each keyword collection (e.g. a mapping from constants). The collection is
+    recognised by identity, so it must not be modified afterwards.
+
+    Args:
+        keywords (iterable): Keywords to look for.
+
+    Returns:
+        KeywordMatcher: Matcher for the keywords.
+
+    """
+    cached = _matchers.get(id(keywords))
+    if cached is None or cached[0] is not keywords:
+        if len(_matchers) >= _MAX_MATCHERS:
+            # Not meant for one-off collections, don't let them pile up.
+            _matchers.clear()
+        cached = keywords, KeywordMatcher(keywords)
+        _matchers[id(keywords)] = cached
+    return cached[1]
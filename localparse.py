@@ -0,0 +1,175 @@
+"""Local fast path of /parse.
+
+Many complaints are short and name observations plainly ("headache", "sore
+throat, no fever"). Once the observation catalog is at hand (see
+catalog.peek), such messages are understood locally with an inverted index
+over the words of the observation names and their common names ("stomach
+ache" as well as "abdominal pain", see catalog.peek_common_names). A message
+is only answered locally if every part of it was understood: each clause
+names exactly one observation, optionally preceded by a negation (see
+constants.NEGATION_NORM). Otherwise /parse is called as usual.
+
+Outcomes are counted in metrics ("localparse_total" by outcome: local, parse
+or no_catalog). A sample of local answers (see
+constants.LOCAL_PARSE_VERIFY_RATE) is checked against /parse and counted in
+"localparse_verified_total" by result (agree or disagree).
+"""
+import collections
+import random
+import re
+
+import apiaccess
+import catalog
+import constants
+import keywordmatch
+import metrics
+
+
+_TOKEN_REGEX = re.compile(r"[\w']+")
+_CLAUSE_REGEX = re.compile(r"[,;.!?]|\b(?:and|but|y|e|pero|mas)\b")
+
+_enabled = True
+_verify_rate = constants.LOCAL_PARSE_VERIFY_RATE
+
+_indexes = {}  # id(naming) -> (naming, common names, index)
+_MAX_INDEXES = 16
+
+
+def configure(enabled=None, verify_rate=None):
+    """Turns the local path on or off and sets the rate of its answers
+    checked against /parse."""
+    global _enabled, _verify_rate
+    if enabled is not None:
+        _enabled = enabled
+    if verify_rate is not None:
+        _verify_rate = verify_rate
+
+
+def tokenize(text):
+    """Returns the lowercase words of the text."""
+    return _TOKEN_REGEX.findall(text.lower())
+
+
+def split_clauses(text):
+    """Returns the clauses of the text (split at punctuation and
+    conjunctions)."""
+    return _CLAUSE_REGEX.split(text)
+
+
+class ComplaintIndex:
+    """Finds observations named by short phrases.
+
+    Args:
+        naming (Mapping): Observation names keyed by ids.
+        common_names (Mapping): Other names of the observations keyed by
+            ids, if any.
+
+    """
+
+    def __init__(self, naming, common_names=None):
+        self._naming = naming
+        self._common_names = common_names or {}
+        self._phrases = []  # (observation id, number of distinct words)
+        self._postings = collections.defaultdict(set)  # word -> phrases
+        for names in (naming, self._common_names):
+            for obs_id, name in names.items():
+                words = set(tokenize(name))
+                if not words or obs_id not in naming:
+                    continue
+                for word in words:
+                    self._postings[word].add(len(self._phrases))
+                self._phrases.append((obs_id, len(words)))
+
+    def lookup(self, words):
+        """Returns the id of the only observation whose name (or common
+        name) consists of exactly these words (in any order), or None."""
+        words = set(words)
+        if not words:
+            return None
+        postings = [self._postings.get(word) for word in words]
+        if not all(postings):
+            return None
+        found = {self._phrases[phrase][0]
+                 for phrase in set.intersection(*postings)
+                 if self._phrases[phrase][1] == len(words)}
+        return found.pop() if len(found) == 1 else None
+
+    def match(self, text):
+        """Returns mentions (as given by /parse) of the observations named in
+        the text, or None unless all of it was understood."""
+        negations = keywordmatch.get_matcher(constants.NEGATION_NORM)
+        mentions = []
+        seen = set()
+        for clause in split_clauses(text):
+            words = tokenize(clause)
+            if not words:
+                continue
+            found = negations.findall(clause)
+            choices = {constants.NEGATION_NORM[phrase] for phrase in found}
+            if len(choices) > 1:
+                return None
+            choice_id = choices.pop() if choices else 'present'
+            negation_words = {word for phrase in found
+                              for word in tokenize(phrase)}
+            content = [word for word in words
+                       if word not in negation_words
+                       and word not in constants.COMPLAINT_FILLER_WORDS]
+            obs_id = self.lookup(content)
+            if obs_id is None:
+                return None
+            if obs_id in seen:
+                continue
+            seen.add(obs_id)
+            name = self._naming[obs_id]
+            mentions.append({
+                'id': obs_id, 'name': name,
+                'common_name': self._common_names.get(obs_id, name),
+                'orth': ' '.join(content), 'choice_id': choice_id,
+                'type': 'symptom' if obs_id.startswith('s_')
+                        else 'risk_factor'})
+        return mentions or None
+
+
+def get_index(naming, common_names=None):
+    """Returns the index of the catalog, building it once per catalog
+    object (recognised by identity, as are the common names)."""
+    cached = _indexes.get(id(naming))
+    if (cached is None or cached[0] is not naming
+            or cached[1] is not common_names):
+        if len(_indexes) >= _MAX_INDEXES:
+            _indexes.clear()
+        cached = naming, common_names, ComplaintIndex(naming, common_names)
+        _indexes[id(naming)] = cached
+    return cached[2]
+
+
+def _count(outcome):
+    metrics.registry.count('localparse_total', (('outcome', outcome),))
+
+
+def parse(age, sex, text, auth_string, case_id, context=(),
+          language_model=None):
+    """Returns the mentions of observations in the text: the "mentions" of
+    /parse response, found locally when possible (see module docstring).
+    Takes the arguments of apiaccess.call_parse."""
+    naming = catalog.peek(age, language_model) if _enabled else None
+    mentions = None
+    if naming is not None:
+        mentions = get_index(naming, catalog.peek_common_names(
+            age, language_model)).match(text)
+    if mentions is not None:
+        _count('local')
+        if random.random() >= _verify_rate:
+            return mentions
+    elif _enabled:
+        _count('parse' if naming is not None else 'no_catalog')
+    resp = apiaccess.call_parse(age, sex, text, auth_string, case_id,
+                                context, language_model=language_model)
+    parsed = resp.get('mentions', [])
+    if mentions is not None:
+        agree = ({(m['id'], m['choice_id']) for m in mentions}
+                 == {(m['id'], m['choice_id']) for m in parsed})
+        metrics.registry.count(
+            'localparse_verified_total',
+            (('result', 'agree' if agree else 'disagree'),))
+    return parsed
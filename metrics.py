@@ -0,0 +1,238 @@
+"""In-process metrics of the API calls.
+
+apiaccess reports every call here (see record_call): durations, payload sizes
+and statuses go to histograms and counters labelled by endpoint and language
+model, which can be exported in the Prometheus text format or as periodic
+snapshots. Hooks get the details of each call along with its case id, so that
+e.g. tracing spans can be tied to a particular interview.
+
+The underlying HTTP library doesn't expose DNS, connect and TLS times; a call
+is split into the time until the response headers arrive (server_seconds),
+the whole transfer and the JSON decoding.
+"""
+import bisect
+import collections
+import threading
+import time
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+PREFIX = 'apiaccess_'
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket bounds.
+
+    Args:
+        buckets (tuple): Ascending upper bounds of the buckets.
+
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """Estimates the given quantile (upper bound of its bucket)."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """Labelled counters, gauges and histograms.
+
+    Attributes:
+        const_labels (tuple): Pairs of label name and value added to all the
+            metrics when they're exported (e.g. the worker of a server with
+            several processes).
+
+    """
+
+    def __init__(self):
+        self.const_labels = ()
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(collections.Counter)
+        self._gauges = collections.defaultdict(dict)
+        self._histograms = collections.defaultdict(dict)
+
+    def count(self, name, labels, value=1):
+        """Adds value to the counter.
+
+        Args:
+            name (str): Metric name.
+            labels (tuple): Pairs of label name and value.
+            value (int): Amount to add.
+
+        """
+        with self._lock:
+            self._counters[name][labels] += value
+
+    def set_gauge(self, name, labels, value):
+        """Sets the current value of the gauge (see count for args)."""
+        with self._lock:
+            self._gauges[name][labels] = value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        """Adds an observation to the histogram (see count for args)."""
+        with self._lock:
+            histogram = self._histograms[name].get(labels)
+            if histogram is None:
+                histogram = self._histograms[name][labels] = Histogram(
+                    buckets)
+            histogram.observe(value)
+
+    def histogram(self, name, labels):
+        """Returns the histogram or None if nothing was observed yet."""
+        with self._lock:
+            return self._histograms.get(name, {}).get(labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """Returns the current values as a JSON-serialisable dict."""
+        const = self.const_labels
+        with self._lock:
+            counters = {
+                name: [{'labels': dict(const + labels), 'value': value}
+                       for labels, value in values.items()]
+                for name, values in self._counters.items()}
+            gauges = {
+                name: [{'labels': dict(const + labels), 'value': value}
+                       for labels, value in values.items()]
+                for name, values in self._gauges.items()}
+            histograms = {
+                name: [{'labels': dict(const + labels),
+                        'count': histogram.count,
+                        'sum': histogram.sum,
+                        'buckets': dict(zip(
+                            [str(bound) for bound in histogram.buckets]
+                            + ['+Inf'], _cumulative(histogram.counts)))}
+                       for labels, histogram in values.items()]
+                for name, values in self._histograms.items()}
+        return {'time': time.time(), 'counters': counters, 'gauges': gauges,
+                'histograms': histograms}
+
+    def export_prometheus(self):
+        """Returns the current values in the Prometheus text format."""
+        const = self.const_labels
+        lines = []
+        with self._lock:
+            for kind, collection in (('counter', self._counters),
+                                    ('gauge', self._gauges)):
+                for name, values in sorted(collection.items()):
+                    lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+                    for labels, value in sorted(values.items()):
+                        lines.append('{}{}{} {}'.format(
+                            PREFIX, name, _format_labels(const + labels),
+                            value))
+            for name, values in sorted(self._histograms.items()):
+                lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+                for labels, histogram in sorted(values.items()):
+                    labels = const + labels
+                    bounds = [repr(float(bound))
+                              for bound in histogram.buckets] + ['+Inf']
+                    for bound, count in zip(
+                            bounds, _cumulative(histogram.counts)):
+                        lines.append('{}{}_bucket{} {}'.format(
+                            PREFIX, name,
+                            _format_labels(labels + (('le', bound),)), count))
+                    lines.append('{}{}_sum{} {}'.format(
+                        PREFIX, name, _format_labels(labels), histogram.sum))
+                    lines.append('{}{}_count{} {}'.format(
+                        PREFIX, name, _format_labels(labels),
+                        histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _cumulative(counts):
+    total = 0
+    cumulative = []
+    for count in counts:
+        total += count
+        cumulative.append(total)
+    return cumulative
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+
+registry = Registry()
+_hooks = []
+
+
+def add_hook(hook):
+    """Registers a function to be called with a dict describing each API
+    call: case_id, endpoint, language_model, started (epoch seconds),
+    seconds, status (None if no response), error (exception class name or
+    None) and, for successful calls, server_seconds, decode_seconds,
+    request_bytes and response_bytes."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def record_call(call):
+    """Records one API call (a dict as described in add_hook)."""
+    labels = (('endpoint', call['endpoint']),
+              ('model', call['language_model'] or ''))
+    registry.count('calls_total', labels + (
+        ('status', str(call['status'] or call['error'])),))
+    registry.observe('call_seconds', labels, call['seconds'])
+    if call.get('server_seconds') is not None:
+        registry.observe('server_seconds', labels, call['server_seconds'])
+        registry.observe('decode_seconds', labels, call['decode_seconds'])
+        registry.observe('request_bytes', labels, call['request_bytes'],
+                         SIZE_BUCKETS)
+        registry.observe('response_bytes', labels, call['response_bytes'],
+                         SIZE_BUCKETS)
+    for hook in list(_hooks):
+        hook(call)
+
+
+def count_cache_event(cache, event, number=1):
+    """Counts cache hits, misses or evictions."""
+    registry.count('cache_events_total', (('cache', cache),
+                                          ('event', event)), number)
+
+
+def start_snapshots(interval, callback):
+    """Calls callback with registry.snapshot() every interval seconds on a
+    daemon thread. Returns an event that stops it when set."""
+    stopped = threading.Event()
+
+    def take_snapshots():
+        while not stopped.wait(interval):
+            callback(registry.snapshot())
+    threading.Thread(target=take_snapshots, name='metrics-snapshots',
+                     daemon=True).start()
+    return stopped
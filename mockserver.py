@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""Local stand-in for the Infermedica API, meant for benchmarks and offline
+development.
+
+It serves /parse, /diagnosis, /triage, /symptoms and /risk_factors. Requests
+found in a recorded traffic log are answered with the recorded responses;
+the rest get synthetic but consistent answers based on a small built-in
+catalog (parse finds catalog names in the text, diagnosis asks about the
+observations not known yet and stops after a few questions). Each response
+can be delayed to emulate network and server latency.
+
+Example:
+    To serve on port 8081 with 50 ms latency (150 ms for /diagnosis)::
+
+        $ python3 mockserver.py --port 8081 --latency 0.05 \\
+              --latency diagnosis=0.15 --replay traffic.jsonl
+
+    then point apiaccess at it with
+    apiaccess.configure_transport(base_url='http://127.0.0.1:8081/v3').
+
+"""
+import argparse
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+import traffic
+
+
+SYMPTOMS = {
+    's_21': 'Headache',
+    's_98': 'Fever',
+    's_102': 'Cough',
+    's_156': 'Nausea',
+    's_13': 'Abdominal pain',
+    's_20': 'Sore throat',
+    's_107': 'Runny nose',
+    's_1193': 'Fatigue',
+    's_370': 'Dizziness',
+    's_305': 'Vomiting',
+    's_8': 'Diarrhea',
+    's_88': 'Shortness of breath',
+    's_50': 'Chest pain',
+    's_241': 'Skin rash',
+    's_44': 'Joint pain',
+    's_1782': 'Muscle pain',
+    's_1535': 'Pain while urinating',
+    's_215': 'Frequent urination',
+    's_476': 'Back pain',
+    's_1394': 'Earache',
+}
+COMMON_NAMES = {
+    's_13': 'Stomach ache',
+    's_88': 'Breathlessness',
+    's_1535': 'Painful urination',
+    's_8': 'Loose stools',
+}
+RISK_FACTORS = {
+    'p_28': 'Smoking',
+    'p_7': 'Obesity',
+    'p_9': 'Hypertension',
+    'p_8': 'Diabetes',
+}
+CONDITIONS = [
+    ('c_87', 'Common cold'),
+    ('c_55', 'Influenza'),
+    ('c_10', 'Migraine'),
+    ('c_312', 'Gastroenteritis'),
+    ('c_57', 'Urinary tract infection'),
+]
+OBSERVATIONS = dict(SYMPTOMS, **RISK_FACTORS)
+NEGATIONS = ('no', 'not', 'without', "don't have", 'never')
+
+
+def synthetic_parse(body):
+    text = ' ' + ' '.join(body.get('text', '').lower().split()) + ' '
+    mentions = []
+    for obs_id, name in OBSERVATIONS.items():
+        pos = text.find(' ' + name.lower())
+        if pos < 0:
+            continue
+        preceding = text[max(0, pos - 20):pos + 1]
+        negated = any(' {} '.format(negation) in preceding
+                      for negation in NEGATIONS)
+        mentions.append({
+            'id': obs_id,
+            'name': name,
+            'common_name': name,
+            'orth': name.lower(),
+            'choice_id': 'absent' if negated else 'present',
+            'type': 'symptom' if obs_id.startswith('s_') else 'risk_factor'})
+    return {'mentions': mentions, 'obvious': bool(mentions)}
+
+
+def _conditions(evidence):
+    present = sum(piece['choice_id'] == 'present' for piece in evidence)
+    rng = random.Random(','.join(sorted(piece['id'] for piece in evidence)))
+    top = min(0.95, 0.2 + 0.1 * present + 0.05 * len(evidence))
+    conditions = []
+    for idx, (cond_id, name) in enumerate(
+            rng.sample(CONDITIONS, len(CONDITIONS))):
+        conditions.append({'id': cond_id, 'name': name, 'common_name': name,
+                           'probability': round(top / (idx + 1), 4)})
+    return conditions
+
+
+_CHOICES = [{'id': 'present', 'label': 'Yes'},
+            {'id': 'absent', 'label': 'No'},
+            {'id': 'unknown', 'label': "Don't know"}]
+
+
+def synthetic_diagnosis(body, max_questions):
+    evidence = body.get('evidence', [])
+    known = {piece['id'] for piece in evidence}
+    answered = sum(piece.get('source') != 'initial' for piece in evidence)
+    unknown = [obs_id for obs_id in SYMPTOMS if obs_id not in known]
+    should_stop = answered >= max_questions or not unknown
+    groups = not body.get('extras', {}).get('disable_groups', False)
+    question = None
+    if not should_stop and groups and len(unknown) > 1:
+        # alternate between the two kinds of group questions
+        kind = ('group_multiple', 'group_single')[len(evidence) % 2]
+        question = {
+            'type': kind,
+            'text': ('Do you have any of the following symptoms?'
+                     if kind == 'group_multiple'
+                     else 'Which of these bothers you the most?'),
+            'items': [{'id': obs_id, 'name': SYMPTOMS[obs_id],
+                       'choices': _CHOICES} for obs_id in unknown[:3]],
+            'extras': {}}
+    elif not should_stop:
+        obs_id = unknown[0]
+        question = {
+            'type': 'single',
+            'text': 'Do you have {}?'.format(SYMPTOMS[obs_id].lower()),
+            'items': [{'id': obs_id, 'name': SYMPTOMS[obs_id],
+                       'choices': _CHOICES}],
+            'extras': {}}
+    return {'question': question, 'conditions': _conditions(evidence),
+            'extras': {}, 'should_stop': should_stop}
+
+
+def synthetic_triage(body):
+    present = sum(piece['choice_id'] == 'present'
+                  for piece in body.get('evidence', []))
+    levels = ('self_care', 'consultation', 'consultation_24',
+              'emergency')
+    return {'triage_level': levels[min(present // 3, len(levels) - 1)],
+            'serious': [], 'root_cause': 'recommendation_from_probabilities',
+            'teleconsultation_applicable': present < 6}
+
+
+def synthetic_catalog(observations):
+    return [{'id': obs_id, 'name': name,
+             'common_name': COMMON_NAMES.get(obs_id, name),
+             'category': 'Categories', 'seriousness': 'normal',
+             'children': [], 'extras': {}}
+            for obs_id, name in observations.items()]
+
+
+class MockApi:
+    """Produces responses of the emulated endpoints.
+
+    Args:
+        recordings (dict): Recorded responses (see traffic.load_recordings).
+        latency (dict): Delay in seconds per endpoint name ("*" for the
+            default one).
+        jitter (float): Maximum random delay added on top of latency.
+        max_questions (int): Number of questions after which synthetic
+            /diagnosis says to stop.
+        error_rate (float): Fraction of requests failed with 503.
+
+    """
+
+    def __init__(self, recordings=None, latency=None, jitter=0.0,
+                 max_questions=8, error_rate=0.0):
+        self.recordings = recordings or {}
+        self.latency = latency or {}
+        self.jitter = jitter
+        self.max_questions = max_questions
+        self.error_rate = error_rate
+        self.replayed = 0
+
+    def respond(self, endpoint, params, body):
+        """Returns (status, response) for the request, after the delay."""
+        delay = self.latency.get(endpoint, self.latency.get('*', 0.0))
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, {'message': 'Service unavailable'}
+        key = traffic.request_key(endpoint, params, body)
+        if key in self.recordings:
+            self.replayed += 1
+            return 200, self.recordings[key]
+        if endpoint == 'parse':
+            return 200, synthetic_parse(body)
+        if endpoint == 'diagnosis':
+            return 200, synthetic_diagnosis(body, self.max_questions)
+        if endpoint == 'triage':
+            return 200, synthetic_triage(body)
+        if endpoint == 'symptoms':
+            return 200, synthetic_catalog(SYMPTOMS)
+        if endpoint == 'risk_factors':
+            return 200, synthetic_catalog(RISK_FACTORS)
+        return 404, {'message': 'Not found'}
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # see server.RequestHandler; otherwise every response would be delayed
+    # by the client's delayed ACK and the latencies measured would be bogus
+    disable_nagle_algorithm = True
+    api = None  # set by make_server
+
+    def do_GET(self):
+        self._handle(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'null')
+        except ValueError:
+            return self._reply(400, {'message': 'Invalid JSON'})
+        self._handle(body)
+
+    def _handle(self, body):
+        url = urllib.parse.urlsplit(self.path)
+        endpoint = url.path.rstrip('/').split('/')[-1]
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if not self.headers.get('App-Id') or not self.headers.get('App-Key'):
+            return self._reply(401, {'message': 'Missing credentials'})
+        self._reply(*self.api.respond(endpoint, params, body))
+
+    def _reply(self, status, content):
+        payload = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host, port, api):
+    """Returns a threading HTTP server emulating the API with api."""
+    handler = type('Handler', (RequestHandler,), {'api': api})
+    return http.server.ThreadingHTTPServer((host, port), handler)
+
+
+def start_in_thread(api, host='127.0.0.1', port=0):
+    """Starts serving in a daemon thread.
+
+    Returns:
+        http.server.ThreadingHTTPServer, str: The server and the base URL to
+            pass to apiaccess.configure_transport.
+
+    """
+    server = make_server(host, port, api)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://{}:{}/v3'.format(*server.server_address[:2])
+
+
+def parse_latency(specs):
+    """Turns "0.05" / "diagnosis=0.15" options into a latency dict."""
+    latency = {}
+    for spec in specs or ():
+        endpoint, _, value = spec.rpartition('=')
+        latency[endpoint or '*'] = float(value)
+    return latency
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on")
+    parser.add_argument("--port", type=int, default=8081,
+                        help="port to listen on")
+    parser.add_argument("--latency", action="append",
+                        help="response delay in seconds, either default "
+                             "(e.g. 0.05) or per endpoint (e.g. "
+                             "diagnosis=0.15); may be repeated")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="maximum random delay added to latency")
+    parser.add_argument("--questions", type=int, default=8,
+                        help="questions asked before /diagnosis says stop")
+    parser.add_argument("--replay", action="append",
+                        help="recorded traffic (JSON lines) to serve "
+                             "responses from; may be repeated")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests to fail with 503")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    recordings = {}
+    for path in args.replay or ():
+        recordings.update(traffic.load_recordings(path))
+    api = MockApi(recordings, parse_latency(args.latency), args.jitter,
+                  args.questions, args.error_rate)
+    server = make_server(args.host, args.port, api)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    run()
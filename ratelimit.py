@@ -0,0 +1,288 @@
+"""Client-side rate limiting of the API calls.
+
+All the calls made with the same App-Id share one Scheduler, which hands out
+tokens from token buckets: one for the application as a whole and, optionally,
+one per endpoint. When there are no tokens, callers wait in a queue ordered
+by priority class (a patient waiting for the next question goes before a
+background catalog refresh) and, within a class, round-robin by case id, so
+that one busy interview can't starve the others. Coroutines wait for their
+turn with Scheduler.acquire_async, without holding a thread.
+"""
+import asyncio
+import collections
+import threading
+import time
+
+import metrics
+
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+
+class TokenBucket:
+    """Allows rate calls per second on average, in bursts of up to capacity.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float): Maximum number of tokens stored.
+
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now):
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+    def wait_time(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Scheduler:
+    """Grants calls to the API within the limits, fairly.
+
+    Args:
+        rate (float): Calls per second allowed in total.
+        burst (float): Size of bursts allowed in total.
+        endpoint_limits (dict): Optional (rate, burst) per endpoint.
+        name (str): Name used in metrics (e.g. App-Id).
+
+    """
+
+    def __init__(self, rate, burst, endpoint_limits=None, name=''):
+        self.name = name
+        self._bucket = TokenBucket(rate, burst)
+        self._endpoint_buckets = {
+            endpoint: TokenBucket(*limits)
+            for endpoint, limits in (endpoint_limits or {}).items()}
+        self._cond = threading.Condition()
+        # priority -> case id -> queue of waiting tickets
+        self._waiting = collections.defaultdict(collections.OrderedDict)
+        self._depth = 0
+
+    def acquire(self, endpoint, case_id, priority=INTERACTIVE):
+        """Blocks until the call may be made. Returns the time waited."""
+        started = time.monotonic()
+        ticket = (endpoint, case_id)
+        with self._cond:
+            self._enqueue(priority, ticket)
+            while True:
+                granted, wait = self._poll(priority, ticket)
+                if granted:
+                    break
+                self._cond.wait(wait)
+        return self._observe(endpoint, priority, started)
+
+    async def acquire_async(self, endpoint, case_id, priority=INTERACTIVE):
+        """Like acquire, but waits in a coroutine, without holding a
+        thread."""
+        started = time.monotonic()
+        ticket = (endpoint, case_id)
+        with self._cond:
+            self._enqueue(priority, ticket)
+        try:
+            while True:
+                with self._cond:
+                    granted, wait = self._poll(priority, ticket)
+                if granted:
+                    break
+                # not woken up by the grants of others like the threads are
+                await asyncio.sleep(0.001 if wait is None else wait)
+        except BaseException:
+            with self._cond:
+                self._withdraw(priority, ticket)
+            raise
+        return self._observe(endpoint, priority, started)
+
+    def _enqueue(self, priority, ticket):
+        self._waiting[priority].setdefault(
+            ticket[1], collections.deque()).append(ticket)
+        self._set_depth(1)
+
+    def _poll(self, priority, ticket):
+        """Grants the ticket if it's its turn. Returns whether it was granted
+        and, if not, how long to wait (None: until another grant)."""
+        now = time.monotonic()
+        granted = self._next_grantable(now)
+        if granted is ticket:
+            self._grant(priority, ticket[1], ticket[0])
+            return True, None
+        if granted is not None:
+            # somebody else goes first, make sure they know it
+            self._cond.notify_all()
+        return False, self._wait_time(now, granted)
+
+    def _withdraw(self, priority, ticket):
+        cases = self._waiting[priority]
+        tickets = cases[ticket[1]]
+        for index, waiting in enumerate(tickets):
+            if waiting is ticket:
+                del tickets[index]
+                break
+        if not tickets:
+            del cases[ticket[1]]
+        if not cases:
+            del self._waiting[priority]
+        self._set_depth(-1)
+        self._cond.notify_all()
+
+    def _observe(self, endpoint, priority, started):
+        waited = time.monotonic() - started
+        metrics.registry.observe(
+            'ratelimit_wait_seconds',
+            (('app', self.name), ('endpoint', endpoint),
+             ('priority', PRIORITY_NAMES.get(priority, str(priority)))),
+            waited)
+        return waited
+
+    def queue_depth(self):
+        return self._depth
+
+    def _buckets(self, endpoint):
+        bucket = self._endpoint_buckets.get(endpoint)
+        return (self._bucket,) if bucket is None else (self._bucket, bucket)
+
+    def _next_grantable(self, now):
+        """Returns the first ticket in fair order whose buckets have tokens
+        (None if there's none)."""
+        for priority in sorted(self._waiting):
+            for tickets in self._waiting[priority].values():
+                endpoint = tickets[0][0]
+                if all(bucket.available(now)
+                       for bucket in self._buckets(endpoint)):
+                    return tickets[0]
+        return None
+
+    def _grant(self, priority, case_id, endpoint):
+        for bucket in self._buckets(endpoint):
+            bucket.take()
+        cases = self._waiting[priority]
+        tickets = cases.pop(case_id)
+        tickets.popleft()
+        if tickets:
+            cases[case_id] = tickets  # back of the round-robin order
+        if not cases:
+            del self._waiting[priority]
+        self._set_depth(-1)
+        self._cond.notify_all()
+
+    def _wait_time(self, now, granted):
+        if granted is not None:
+            return None  # woken up by their grant
+        waits = [bucket.wait_time(now)
+                 for tickets in self._all_heads()
+                 for bucket in self._buckets(tickets[0][0])]
+        return max(0.001, min(waits)) if waits else None
+
+    def _all_heads(self):
+        for cases in self._waiting.values():
+            yield from cases.values()
+
+    def _set_depth(self, change):
+        self._depth += change
+        metrics.registry.set_gauge('ratelimit_queue_depth',
+                                   (('app', self.name),), self._depth)
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+_limits = None  # (rate, burst, endpoint limits)
+
+
+def configure(rate=None, burst=None, endpoint_limits=None):
+    """Turns rate limiting on, or off if no limits are given.
+
+    Args:
+        rate (float): Calls per second allowed per App-Id (unlimited if
+            None but endpoint_limits are given).
+        burst (float): Size of bursts allowed (rate by default, but at
+            least one call).
+        endpoint_limits (dict): Optional (rate, burst) per endpoint, e.g.
+            {'parse': (5, 10)}; burst may be None.
+
+    Raises:
+        ValueError: If a rate isn't positive or a burst is below one call
+            (no call could ever be made).
+
+    """
+    global _limits
+    if rate is None and not endpoint_limits:
+        limits = None
+    else:
+        rate, burst = _bucket_limits(
+            float('inf') if rate is None else rate, burst)
+        limits = rate, burst, {
+            endpoint: _bucket_limits(*endpoint_limit)
+            for endpoint, endpoint_limit in (endpoint_limits or {}).items()}
+    with _schedulers_lock:
+        _schedulers.clear()
+        _limits = limits
+
+
+def _bucket_limits(rate, burst=None):
+    if burst is None:
+        burst = max(1.0, rate)
+    if not rate > 0 or not burst >= 1:
+        raise ValueError('rate limit must be positive and its burst at '
+                         'least 1, got {}:{}'.format(rate, burst))
+    return rate, burst
+
+
+def parse_limits(specs):
+    """Turns "10" / "10:20" / "parse=5:10" options (calls per second and
+    optional burst, in total or per endpoint) into configure arguments."""
+    limits = {}
+    for spec in specs or ():
+        endpoint, _, value = spec.rpartition('=')
+        rate, _, burst = value.partition(':')
+        limits[endpoint or '*'] = (float(rate),
+                                   float(burst) if burst else None)
+    rate, burst = limits.pop('*', (None, None))
+    return {'rate': rate, 'burst': burst, 'endpoint_limits': limits}
+
+
+def divide_limits(limits, parts):
+    """Returns the configure arguments (as given by parse_limits) giving each
+    of parts processes its share of the limits. Bursts are kept at one call
+    at least, so together the processes may burst a little more."""
+    def share(rate, burst):
+        return (None if rate is None else rate / parts,
+                None if burst is None else max(1.0, burst / parts))
+    rate, burst = share(limits['rate'], limits['burst'])
+    return {'rate': rate, 'burst': burst, 'endpoint_limits': {
+        endpoint: share(*endpoint_limit)
+        for endpoint, endpoint_limit in limits['endpoint_limits'].items()}}
+
+
+def get_scheduler(app_id):
+    """Returns the scheduler shared by all the calls made with the App-Id, or
+    None if rate limiting is off."""
+    if _limits is None:
+        return None
+    scheduler = _schedulers.get(app_id)
+    if scheduler is None:
+        with _schedulers_lock:
+            scheduler = _schedulers.get(app_id)
+            if scheduler is None and _limits is not None:
+                rate, burst, endpoint_limits = _limits
+                scheduler = _schedulers[app_id] = Scheduler(
+                    rate, burst, endpoint_limits, name=app_id)
+    return scheduler
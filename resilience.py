@@ -0,0 +1,221 @@
+"""Resilience policy of the API calls: retries, circuit breakers and hedging.
+
+* Failed calls that are safe to repeat are retried a bounded number of times
+  with jittered exponential backoff; a Retry-After given with 429 (or 503)
+  is honoured.
+* Each endpoint has its own circuit breaker. After a number of consecutive
+  failures the endpoint is not called at all for a while, then a single
+  trial call decides whether it's back.
+* Optionally, a call that takes longer than the given latency percentile of
+  its endpoint is hedged: a second, identical request is sent, and the
+  first successful response of the two is used.
+"""
+import concurrent.futures
+import contextlib
+import email.utils
+import math
+import os
+import random
+import threading
+import time
+
+import requests
+
+import constants
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# All the endpoints used here only compute or look things up, so repeating a
+# request is harmless.
+IDEMPOTENT_ENDPOINTS = ('parse', 'diagnosis', 'triage', 'symptoms',
+                        'risk_factors', 'suggest', 'explain')
+
+
+class CircuitOpenError(IOError):
+    pass
+
+
+def _status(error):
+    response = getattr(error, 'response', None)
+    return response.status_code if response is not None else None
+
+
+def is_transient(error):
+    """Tells whether the error may go away when the call is repeated."""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return _status(error) in RETRY_STATUSES
+
+
+def retry_after(error):
+    """Returns the delay (in seconds) requested by the Retry-After header of
+    the error response, or None."""
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None \
+        else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class RetryPolicy:
+    """Decides whether and when to retry a failed call.
+
+    Args:
+        max_attempts (int): Maximum number of attempts, the first included.
+        base_delay (float): Backoff delay (in seconds) before the first retry;
+            doubled with each next one.
+        max_delay (float): Maximum backoff delay.
+        max_retry_after (float): Maximum delay accepted from Retry-After;
+            calls asked to wait longer are not retried.
+        endpoints (tuple): Endpoints that may be retried.
+
+    """
+
+    def __init__(self, max_attempts=constants.RETRY_MAX_ATTEMPTS,
+                 base_delay=constants.RETRY_BASE_DELAY,
+                 max_delay=constants.RETRY_MAX_DELAY,
+                 max_retry_after=constants.RETRY_AFTER_MAX,
+                 endpoints=IDEMPOTENT_ENDPOINTS):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.endpoints = endpoints
+
+    def delay(self, endpoint, error, attempt):
+        """Returns the number of seconds to wait before retrying the call
+        that failed on the given attempt (counted from 1), or None if it
+        shouldn't be retried."""
+        if attempt >= self.max_attempts or endpoint not in self.endpoints:
+            return None
+        if not is_transient(error):
+            return None
+        requested = retry_after(error)
+        if requested is not None:
+            return requested if requested <= self.max_retry_after else None
+        # "full jitter" keeps retries of many clients from synchronising
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Stops calling an endpoint that keeps failing.
+
+    Args:
+        failure_threshold (int): Consecutive failures that open the circuit.
+        reset_timeout (float): Seconds after which a trial call is let
+            through an open circuit.
+
+    """
+
+    def __init__(self, failure_threshold=constants.CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=constants.CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def before_call(self, endpoint):
+        """Raises CircuitOpenError unless the call may go through."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return
+        raise CircuitOpenError('/{} is failing, not calling it for '
+                               'now'.format(endpoint))
+
+    @contextlib.contextmanager
+    def calling(self, endpoint):
+        """Context of one call: raises CircuitOpenError unless the call may
+        go through (see before_call). The outcome is to be recorded inside;
+        a trial call that ends without one (e.g. on an unexpected error)
+        doesn't keep the circuit open for good."""
+        self.before_call(endpoint)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # threads don't survive fork()
+    global _hedge_executor, _hedge_executor_lock
+    _hedge_executor = None
+    _hedge_executor_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=constants.HEDGE_POOL_SIZE,
+                    thread_name_prefix='hedge')
+    return _hedge_executor
+
+
+def hedged_call(func, hedge_delay):
+    """Calls func() and, if it hasn't returned after hedge_delay seconds,
+    calls it once more, concurrently. Returns the result of whichever call
+    succeeds first (the first error only if both fail) and whether the hedge
+    was sent; the slower call is left to finish on its own."""
+    if not math.isfinite(hedge_delay):
+        return func(), False
+    executor = _get_hedge_executor()
+    first = executor.submit(func)
+    if concurrent.futures.wait((first,), timeout=hedge_delay).done:
+        return first.result(), False
+    pending = {first, executor.submit(func)}
+    while pending:
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result(), True
+    return first.result(), True
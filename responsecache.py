@@ -0,0 +1,255 @@
+"""Caching of API responses.
+
+A ResponseCache keeps responses (anything JSON-serialisable) under keys built
+from the request, bounded both in size (least recently used entries are
+evicted) and in time (entries expire after ttl seconds). Responses are stored
+encoded, so a cached response can't be altered by the code that got it.
+
+The storage is pluggable: MemoryBackend serves one process, SqliteBackend
+keeps entries in a local database file that may be shared by many worker
+processes.
+"""
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import metrics
+
+
+def age_band(age, bounds):
+    """Returns the band the given age falls into.
+
+    Args:
+        age (dict): Patients age in {'value': int, 'unit': str} format.
+        bounds (tuple): Ascending lower bounds (in years) of the bands.
+
+    Returns:
+        int: Lower bound of the band.
+
+    """
+    years = age['value']
+    if age.get('unit', 'year') == 'month':
+        years = years // 12
+    band = bounds[0]
+    for bound in bounds:
+        if years >= bound:
+            band = bound
+    return band
+
+
+def make_key(*parts):
+    """Returns a compact, canonical key for the given JSON-serialisable
+    parts."""
+    encoded = json.dumps(parts, sort_keys=True, separators=(',', ':'),
+                         ensure_ascii=False)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+class MemoryBackend:
+    """In-process LRU storage.
+
+    Args:
+        max_size (int): Maximum number of entries.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (expiry time, encoded value) or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, expires, value):
+        """Stores the entry; returns the number of entries evicted."""
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def items(self):
+        """Returns all (key, expiry time, encoded value) entries, least
+        recently used first."""
+        with self._lock:
+            return [(key, expires, value)
+                    for key, (expires, value) in self._entries.items()]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteBackend:
+    """LRU storage in an SQLite database file, which can be shared by all the
+    worker processes on a host.
+
+    Args:
+        path (str): Database file.
+        max_size (int): Maximum number of entries.
+        table (str): Table to use, so that one file can hold several caches.
+
+    """
+
+    def __init__(self, path, max_size, table='responses'):
+        self.max_size = max_size
+        self._table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30,
+                                     check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, '
+            'expires REAL, used REAL, value TEXT)'.format(table))
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS {0}_used ON {0} (used)'.format(table))
+
+    def get(self, key):
+        """Returns (expiry time, encoded value) or None."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT expires, value FROM {} WHERE key = ?'.format(
+                    self._table), (key,)).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    'UPDATE {} SET used = ? WHERE key = ?'.format(self._table),
+                    (time.time(), key))
+            return row
+
+    def set(self, key, expires, value):
+        """Stores the entry; returns the number of entries evicted."""
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?)'.format(
+                    self._table), (key, expires, time.time(), value))
+            excess = self._count() - self.max_size
+            if excess <= 0:
+                return 0
+            self._conn.execute(
+                'DELETE FROM {0} WHERE key IN (SELECT key FROM {0} '
+                'ORDER BY used LIMIT ?)'.format(self._table), (excess,))
+            return excess
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM {} WHERE key = ?'.format(self._table), (key,))
+
+    def items(self):
+        """Returns all (key, expiry time, encoded value) entries, least
+        recently used first."""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT key, expires, value FROM {} ORDER BY used'.format(
+                    self._table)).fetchall()
+
+    def _count(self):
+        return self._conn.execute(
+            'SELECT COUNT(*) FROM {}'.format(self._table)).fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._count()
+
+
+class ResponseCache:
+    """Size- and time-bounded cache of responses.
+
+    Args:
+        backend: Storage, e.g. MemoryBackend or SqliteBackend.
+        ttl (float): Number of seconds after which entries expire.
+        name (str): Name under which the events are reported to metrics.
+
+    Attributes:
+        stats (collections.Counter): Numbers of "hits", "misses" and
+            "evictions" (including expired entries dropped).
+
+    """
+
+    def __init__(self, backend, ttl, name='responses'):
+        self.backend = backend
+        self.ttl = ttl
+        self.name = name
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, event, number=1):
+        with self._stats_lock:
+            self.stats[event] += number
+        metrics.count_cache_event(self.name, event, number)
+
+    def get(self, key):
+        """Returns the cached response or None."""
+        entry = self.backend.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.time():
+                self._count('hits')
+                return json.loads(value)
+            self.backend.delete(key)
+            self._count('evictions')
+        self._count('misses')
+        return None
+
+    def put(self, key, response):
+        evicted = self.backend.set(key, time.time() + self.ttl,
+                                   json.dumps(response))
+        if evicted:
+            self._count('evictions', evicted)
+
+    def get_or_call(self, key, func):
+        """Returns the cached response or, if there's none, the result of
+        func() (caching it)."""
+        response = self.get(key)
+        if response is None:
+            response = func()
+            self.put(key, response)
+        return response
+
+    def save(self, path, limit=None):
+        """Writes the most recently used entries (all of them unless limit is
+        given) that haven't expired yet to a JSON lines file."""
+        now = time.time()
+        entries = [entry for entry in self.backend.items() if entry[1] > now]
+        if limit is not None:
+            entries = entries[-limit:] if limit else []
+        with open(path, 'w', encoding='utf-8') as stream:
+            for entry in entries:
+                stream.write(json.dumps(list(entry)) + '\n')
+        return len(entries)
+
+    def load(self, path):
+        """Adds the unexpired entries stored by save(). Returns their number
+        (zero if there's no such file)."""
+        now = time.time()
+        loaded = 0
+        try:
+            with open(path, encoding='utf-8') as stream:
+                for line in stream:
+                    key, expires, value = json.loads(line)
+                    if expires > now:
+                        self.backend.set(key, expires, value)
+                        loaded += 1
+        except FileNotFoundError:
+            pass
+        return loaded
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""Multi-session HTTP server for the example chatbot.
+
+Unlike chat.py, which conducts one interview reading from the console, this
+hosts any number of concurrent conversations in one process. Each of them is
+identified by its case id and advanced one user message at a time (see
+conversation.step).
+
+Example:
+    To start the server type::
+
+        $ python3 server.py APP_ID:APP_KEY --port 8080
+
+    Then start a conversation and keep sending user messages to it::
+
+        $ curl -X POST localhost:8080/sessions
+        {"case_id": "5f0c...", "messages": ["Patient age and sex ..."], ...}
+        $ curl -X POST localhost:8080/sessions/5f0c... -d '{"text": "30 male"}'
+        {"case_id": "5f0c...", "messages": ["Ok, 30 year old male.", ...], ...}
+
+    Every response carries the bot messages to display and the "finished"
+    flag, raised along with the final summary.
+
+    Idle conversations beyond the memory budget (--session-memory) are
+    spilled to disk (see sessionstore.py).
+
+"""
+import argparse
+import http.server
+import json
+import threading
+import traceback
+
+import requests
+
+import apiaccess
+import catalog
+import chat
+import constants
+import conversation
+import localparse
+import metrics
+import ratelimit
+import sessionstore
+
+
+class UnknownSessionError(KeyError):
+    pass
+
+
+class SessionManager:
+    """Keeps the sessions of one server.
+
+    Args:
+        auth_string (str): Authentication string.
+        language_model (str): Chosen language model.
+        prefetch_triage (str): Triage prefetch mode.
+        no_groups (bool): Ask single questions only.
+        store (sessionstore.SessionStore): Where the sessions are kept (one
+            with the default memory budget by default).
+
+    """
+
+    def __init__(self, auth_string, language_model=None,
+                 prefetch_triage=None, no_groups=True, store=None):
+        self.auth_string = auth_string
+        self.language_model = language_model
+        self.prefetch_triage = prefetch_triage
+        self.no_groups = no_groups
+        if store is None:
+            store = sessionstore.SessionStore()
+        self.store = store
+        # Messages of one session are handled one at a time; sessions share
+        # a fixed set of locks, so that idle sessions hold none.
+        self._locks = [threading.Lock()
+                       for _ in range(constants.SESSION_LOCK_STRIPES)]
+
+    def _lock(self, case_id):
+        return self._locks[hash(case_id) % len(self._locks)]
+
+    def create(self):
+        """Starts a new session.
+
+        Returns:
+            conversation.InterviewState, list: The session state and its
+                opening messages.
+
+        """
+        state = conversation.InterviewState(chat.new_case_id())
+        messages = conversation.start(state)
+        self.store.checkin(state)
+        return state, messages
+
+    def handle(self, case_id, text):
+        """Passes the user message to the session; forgets the session once
+        it's finished.
+
+        Returns:
+            conversation.InterviewState, list: The session state and messages
+                to be displayed.
+
+        Raises:
+            UnknownSessionError: If there's no such session.
+            sessionstore.SessionBusyError: If another process (see
+                supervisor.py) keeps handling a message of the session.
+
+        """
+        with self._lock(case_id):
+            state = self.store.checkout(case_id)
+            if state is None:
+                raise UnknownSessionError(case_id)
+            try:
+                messages = conversation.step(state, text, self.auth_string,
+                                             self.language_model,
+                                             self.prefetch_triage,
+                                             self.no_groups)
+            finally:
+                if state.finished:
+                    self.store.discard(case_id)
+                else:
+                    self.store.checkin(state)
+        return state, messages
+
+    def __len__(self):
+        return len(self.store)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles POST /sessions and POST /sessions/<case_id>, and serves API
+    call metrics at GET /metrics."""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; on a kept-alive connection
+    # Nagle's algorithm would hold the body back until the client's delayed
+    # ACK (some 40 ms per response).
+    disable_nagle_algorithm = True
+    manager = None  # set by make_server
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            return self._reply(404, {'error': 'not found'})
+        payload = metrics.registry.export_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return self._reply(400, {'error': 'invalid JSON'})
+        if not isinstance(body, dict):
+            return self._reply(400, {'error': 'JSON object expected'})
+        try:
+            if parts == ['sessions']:
+                state, messages = self.manager.create()
+            elif len(parts) == 2 and parts[0] == 'sessions':
+                state, messages = self.manager.handle(
+                    parts[1], str(body.get('text', '')))
+            else:
+                return self._reply(404, {'error': 'not found'})
+        except UnknownSessionError:
+            return self._reply(404, {'error': 'unknown session'})
+        except sessionstore.SessionBusyError:
+            return self._reply(409, {'error': 'session busy'})
+        except (IOError, requests.RequestException) as e:
+            return self._reply(502, {'error': str(e)})
+        except Exception:
+            traceback.print_exc()
+            return self._reply(500, {'error': 'internal error'})
+        self._reply(200, {'case_id': state.case_id, 'messages': messages,
+                          'finished': state.finished})
+
+    def _reply(self, status, content):
+        payload = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host, port, manager, sock=None):
+    """Returns a threading HTTP server handling the sessions of manager. Give
+    sock to serve on an already listening socket (host and port are ignored
+    then)."""
+    handler = type('Handler', (RequestHandler,), {'manager': manager})
+    if sock is None:
+        return http.server.ThreadingHTTPServer((host, port), handler)
+    server = http.server.ThreadingHTTPServer(sock.getsockname()[:2], handler,
+                                             bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    return server
+
+
+def add_api_arguments(parser):
+    """Adds the options of the programs talking to the API (applied by
+    setup) to the parser and returns it."""
+    parser.add_argument("auth",
+                        help="authentication string for Infermedica API: "
+                             "APP_ID:APP_KEY or path to file containing it.")
+    parser.add_argument("--model",
+                        help="use non-standard Infermedica model/language, "
+                             "e.g. infermedica-es")
+    parser.add_argument("--api-url",
+                        help="API base URL (Infermedica API by default)")
+    parser.add_argument("--catalog-dir",
+                        help="directory to keep observation catalog "
+                             "snapshots in")
+    parser.add_argument("--prefetch-triage", choices=("always", "near_stop"),
+                        help="call /triage along with /diagnosis to get the "
+                             "final results sooner")
+    parser.add_argument("--group-questions", action="store_true",
+                        help="let /diagnosis ask group questions (fewer "
+                             "round trips per interview)")
+    parser.add_argument("--record",
+                        help="log all API traffic to this file")
+    parser.add_argument("--replay", action="append",
+                        help="answer API calls from this traffic log instead "
+                             "of the network; may be repeated")
+    parser.add_argument("--cache-db",
+                        help="SQLite file to cache API responses in")
+    parser.add_argument("--rate-limit", action="append",
+                        help="API calls per second (and burst) allowed per "
+                             "App-Id, either in total (e.g. 10 or 10:20) or "
+                             "per endpoint (e.g. parse=5:10); may be "
+                             "repeated")
+    parser.add_argument("--no-local-parse", action="store_true",
+                        help="always call /parse, even for complaints that "
+                             "can be understood from the catalog")
+    parser.add_argument("--local-parse-verify-rate", type=float,
+                        default=constants.LOCAL_PARSE_VERIFY_RATE,
+                        help="fraction of the complaints understood locally "
+                             "to check against /parse (reported in "
+                             "localparse_verified_total)")
+    return parser
+
+
+def make_parser():
+    """Returns the parser of the server options (see parse_args)."""
+    parser = add_api_arguments(argparse.ArgumentParser())
+    parser.add_argument("--session-memory", type=float,
+                        default=constants.SESSION_STORE_MAX_BYTES / 2 ** 20,
+                        help="MiB of memory for the sessions; idle ones "
+                             "beyond that are spilled to disk")
+    parser.add_argument("--session-db",
+                        help="SQLite file to spill idle sessions to (a "
+                             "temporary file by default)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="port to listen on")
+    return parser
+
+
+def parse_args():
+    """Parses command line arguments.
+
+    Returns:
+        argparse.Namespace: Namespace containing the chat.py options plus
+            host and port to listen on.
+    """
+    return make_parser().parse_args()
+
+
+def setup(args):
+    """Configures the modules according to the options and returns the
+    authentication string."""
+    auth_string = chat.get_auth_string(args.auth)
+    if args.api_url:
+        apiaccess.configure_transport(base_url=args.api_url)
+    catalog.configure(snapshot_dir=args.catalog_dir)
+    localparse.configure(enabled=not args.no_local_parse,
+                         verify_rate=args.local_parse_verify_rate)
+    if args.cache_db:
+        apiaccess.configure_parse_cache(args.cache_db)
+        apiaccess.configure_interview_cache(args.cache_db)
+    if args.record:
+        apiaccess.record_traffic(args.record)
+    if args.replay:
+        apiaccess.replay_traffic(*args.replay)
+    ratelimit.configure(**ratelimit.parse_limits(args.rate_limit))
+    return auth_string
+
+
+def run():
+    """Runs the server until interrupted."""
+    args = parse_args()
+    auth_string = setup(args)
+    store = sessionstore.SessionStore(int(args.session_memory * 2 ** 20),
+                                      args.session_db)
+    manager = SessionManager(auth_string, args.model, args.prefetch_triage,
+                             not args.group_questions, store)
+    server = make_server(args.host, args.port, manager)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,251 @@
+"""Memory-bounded store of the conversations hosted by a server.
+
+Users pause for minutes between answers, so most of the live conversations
+are idle at any moment. A SessionStore keeps the states (see
+conversation.InterviewState) in memory up to a byte budget; beyond it, the
+least recently used idle ones are spilled to a local SQLite file, compressed,
+and brought back transparently on their next message. Conversations idle for
+longer than the store's ttl are dropped from the disk.
+
+Several processes may share the file (with a memory budget of 0, so that
+all the states are kept there, see supervisor.py). A state taken out of the
+file stays there, leased by the process handling its message, until it's
+given back; the others wait for it meanwhile. The leases of processes that
+died are taken over, so a crash loses only the message being handled.
+
+Reported to metrics: gauges "sessions_resident" and
+"sessions_resident_bytes", counters "sessions_spilled_total" and
+"sessions_rehydrated_total", and histogram "session_rehydrate_seconds".
+"""
+import collections
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import constants
+import conversation
+import metrics
+
+
+def _size(value):
+    """Returns the approximate number of bytes held by a JSON-like value."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_size(key) + _size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_size(item) for item in value)
+    return size
+
+
+def footprint(state):
+    """Returns the approximate number of bytes held by the conversation
+    state (evidence pieces and catalogs, shared by all of them, not
+    counted)."""
+    return (sys.getsizeof(state) + state.evidence.footprint()
+            + _size(state.context) + _size(state.question)
+            + _size(state.case_id))
+
+
+class SessionBusyError(Exception):
+    """The state is held by another process for too long."""
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SessionStore:
+    """Conversation states keyed by case id, kept in memory up to max_bytes
+    and spilled to disk beyond that.
+
+    States are taken out with checkout and given back with checkin once the
+    message has been handled; states checked out are never spilled.
+
+    Args:
+        max_bytes (int): Memory budget of the states kept in memory (0 keeps
+            all of them on disk only).
+        path (str): SQLite file to spill the states to (a temporary file,
+            removed by close, by default).
+        ttl (float): Number of seconds after which a spilled state is
+            dropped.
+
+    """
+
+    def __init__(self, max_bytes=constants.SESSION_STORE_MAX_BYTES,
+                 path=None, ttl=constants.SESSION_IDLE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._temporary = path is None
+        if path is None:
+            handle, path = tempfile.mkstemp(prefix='sessions-',
+                                            suffix='.sqlite')
+            os.close(handle)
+        self.path = path
+        self._resident = collections.OrderedDict()  # case id -> (state, size)
+        self._checked_out = {}  # case id -> size
+        self._leased = set()  # case ids of the states checked out from disk
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._last_purge = time.time()
+        self._conn = sqlite3.connect(path, timeout=30,
+                                     check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS sessions (case_id TEXT PRIMARY KEY, '
+            'used REAL, state BLOB, owner INTEGER, leased_until REAL)')
+        columns = {row[1] for row in self._conn.execute(
+            'PRAGMA table_info(sessions)')}
+        for column in ('owner INTEGER', 'leased_until REAL'):
+            if column.split()[0] not in columns:  # file of an older version
+                self._conn.execute(
+                    'ALTER TABLE sessions ADD COLUMN ' + column)
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS sessions_used ON sessions (used)')
+
+    def checkout(self, case_id, timeout=constants.SESSION_LEASE_WAIT):
+        """Takes the state out of the store, from memory or from the disk
+        (leasing it there), waiting up to timeout seconds for another
+        process sharing the file to give it back.
+
+        Returns:
+            conversation.InterviewState: The state, or None if there's no
+                such conversation.
+
+        Raises:
+            SessionBusyError: If another process still holds the state.
+
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                entry = self._resident.pop(case_id, None)
+                if entry is not None:
+                    self._checked_out[case_id] = entry[1]
+                    return entry[0]
+                started = time.perf_counter()
+                blob = self._lease(case_id)
+                if blob is None:
+                    return None
+                if blob is not False:
+                    state = conversation.InterviewState.loads(
+                        zlib.decompress(blob))
+                    self._checked_out[case_id] = 0
+                    self._leased.add(case_id)
+                    break
+            if time.monotonic() >= deadline:
+                raise SessionBusyError(case_id)
+            time.sleep(constants.SESSION_LEASE_POLL)
+        metrics.registry.count('sessions_rehydrated_total', ())
+        metrics.registry.observe('session_rehydrate_seconds', (),
+                                 time.perf_counter() - started)
+        return state
+
+    def _lease(self, case_id):
+        """Leases the state on disk to this process. Returns the compressed
+        state, None if there's no such conversation or False if it's leased
+        by another (live) process."""
+        now = time.time()
+        pid = os.getpid()
+        with self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            row = self._conn.execute(
+                'SELECT state, owner, leased_until FROM sessions '
+                'WHERE case_id = ?', (case_id,)).fetchone()
+            if row is None:
+                return None
+            blob, owner, leased_until = row
+            if (owner is not None and owner != pid and leased_until > now
+                    and _alive(owner)):
+                return False
+            self._conn.execute(
+                'UPDATE sessions SET used = ?, owner = ?, leased_until = ? '
+                'WHERE case_id = ?',
+                (now, pid, now + constants.SESSION_LEASE_TTL, case_id))
+        return blob
+
+    def checkin(self, state):
+        """Puts the (new or checked out) state back, spilling the least
+        recently used states if the memory budget is exceeded."""
+        size = footprint(state)
+        with self._lock:
+            self._bytes += size - self._checked_out.pop(state.case_id, 0)
+            self._resident[state.case_id] = state, size
+            spilled = self._spill()
+            if (state.case_id in self._leased
+                    and state.case_id in self._resident):
+                # kept in memory: the copy on disk would only get stale
+                self._conn.execute('DELETE FROM sessions WHERE case_id = ?',
+                                   (state.case_id,))
+            self._leased.discard(state.case_id)
+            self._report()
+        if spilled:
+            metrics.registry.count('sessions_spilled_total', (), spilled)
+
+    def discard(self, case_id):
+        """Forgets the (checked out) conversation."""
+        with self._lock:
+            self._bytes -= self._checked_out.pop(case_id, 0)
+            self._leased.discard(case_id)
+            entry = self._resident.pop(case_id, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+            self._conn.execute('DELETE FROM sessions WHERE case_id = ?',
+                               (case_id,))
+            self._report()
+
+    def _spill(self):
+        now = time.time()
+        rows = []
+        while self._bytes > self.max_bytes and self._resident:
+            case_id, (state, size) = self._resident.popitem(last=False)
+            self._bytes -= size
+            rows.append((case_id, now, zlib.compress(state.dumps())))
+        if rows:
+            # given back to the other processes (the lease is dropped)
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO sessions (case_id, used, state) '
+                'VALUES (?, ?, ?)', rows)
+        if now - self._last_purge > min(self.ttl, 60):
+            self._conn.execute('DELETE FROM sessions WHERE used < ?',
+                               (now - self.ttl,))
+            self._last_purge = now
+        return len(rows)
+
+    def _report(self):
+        resident = len(self._resident) + len(self._checked_out)
+        metrics.registry.set_gauge('sessions_resident', (), resident)
+        metrics.registry.set_gauge('sessions_resident_bytes', (), self._bytes)
+
+    def spilled(self):
+        """Returns the number of states on disk (not leased)."""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM sessions WHERE owner IS NULL'
+            ).fetchone()[0]
+
+    def __len__(self):
+        """Number of states in memory and on disk."""
+        with self._lock:
+            resident = len(self._resident) + len(self._checked_out)
+        return resident + self.spilled()
+
+    def close(self):
+        self._conn.close()
+        if self._temporary:
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,103 @@
+"""Coalescing of identical calls in flight.
+
+When many sessions make the same request at the same moment (catalog loads
+after a start or cache expiry, /diagnosis of a common opening complaint),
+only the first one is actually made; the others wait for it and get its
+result, or its exception. A result given to a waiter is a copy, so it can't
+be altered by the code that got the original (unless the group is told the
+results are immutable).
+
+Waiting works for threads (Group.do) as well as for asyncio tasks
+(Group.do_async and Group.join, which don't hold a thread while waiting).
+"""
+import asyncio
+import concurrent.futures
+import copy
+import threading
+
+import metrics
+
+
+class Group:
+    """Calls in flight, by key.
+
+    Args:
+        name (str): Name under which coalesced calls are counted in metrics
+            ("singleflight_coalesced_total").
+        copy_results (bool): Give waiters copies of the result (turn off for
+            results that are never altered).
+
+    """
+
+    def __init__(self, name='calls', copy_results=True):
+        self.name = name
+        self.copy_results = copy_results
+        self._calls = {}  # key -> concurrent.futures.Future
+        self._lock = threading.Lock()
+
+    def in_flight(self, key):
+        """Returns the future of the call with the key in flight, or None."""
+        return self._calls.get(key)
+
+    def do(self, key, func):
+        """Returns func(), or the result of the call with the same key that's
+        already in flight."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            self._count()
+            return self._copy(future.result())
+        try:
+            result = func()
+        except BaseException as e:
+            self._finish(key)
+            future.set_exception(e)
+            raise
+        self._finish(key)
+        future.set_result(result)
+        return result
+
+    async def do_async(self, key, func):
+        """Like do, in a coroutine: returns await func(), or the result of
+        the call with the same key that's already in flight (made by a
+        thread or by another task)."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            return await self.join(future)
+        try:
+            result = await func()
+        except BaseException as e:
+            self._finish(key)
+            future.set_exception(e)
+            raise
+        self._finish(key)
+        future.set_result(result)
+        return result
+
+    async def join(self, future):
+        """Waits (in a coroutine) for the call of the future obtained from
+        in_flight and returns its result."""
+        self._count()
+        return self._copy(await asyncio.wrap_future(future))
+
+    def _copy(self, result):
+        return copy.deepcopy(result) if self.copy_results else result
+
+    def _finish(self, key):
+        # calls starting from now on are made anew
+        with self._lock:
+            del self._calls[key]
+
+    def _count(self):
+        metrics.registry.count('singleflight_coalesced_total',
+                               (('group', self.name),))
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Preforking supervisor of server.py workers.
+
+Starting a bot process means starting the interpreter, importing requests,
+reading the auth file and downloading the observation catalog before the
+first prompt can be shown. The supervisor does all of that once: it loads
+the modules, the auth string and the catalogs of all the age bands (kept as
+memory-mapped snapshots, see catalogfile.py, so the workers share one copy)
+and opens the listening socket. Then it forks the workers, which inherit
+that warm state and serve new conversations right away. Workers that die are
+restarted.
+
+The workers keep the sessions in a session store (see sessionstore.py)
+shared through its SQLite file, so any worker can handle the next message
+of a conversation. Each worker is given its share of the rate limits
+(--rate-limit divided by --workers). Metrics (GET /metrics) are kept per
+worker and labelled with its number ("worker", from 0), which a restarted
+worker takes over.
+
+Example:
+    Serve with one worker per core::
+
+        $ python3 supervisor.py APP_ID:APP_KEY --port 8080
+
+"""
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+import requests
+
+import apiaccess
+import catalog
+import constants
+import localparse
+import metrics
+import ratelimit
+import server
+import sessionstore
+
+
+def default_workers():
+    """Returns the number of cores available to the process."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def warm_catalogs(auth_string, language_model=None):
+    """Loads the catalogs of all the age bands (and their local parse
+    indexes). Returns the number loaded; failures are reported, the workers
+    will then fetch the catalogs when first needed."""
+    loaded = 0
+    for bucket in constants.AGE_BANDS:
+        age = {'value': bucket, 'unit': 'year'}
+        try:
+            naming = catalog.get_naming(age, auth_string, 'supervisor',
+                                        language_model)
+        except (IOError, requests.RequestException) as e:
+            print('catalog for age {} not loaded: {}'.format(bucket, e),
+                  file=sys.stderr)
+            continue
+        localparse.get_index(naming, catalog.peek_common_names(
+            age, language_model))
+        loaded += 1
+    return loaded
+
+
+def listen(host, port):
+    """Returns the listening socket shared by the workers."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    return sock
+
+
+def serve(sock, args, auth_string, session_db, worker):
+    """Runs one worker (in the forked process) until it's terminated. The
+    files written by the workers (caches, traffic logs, session store) are
+    opened here, after the fork, so that no SQLite connection or open file
+    is shared with the supervisor or the other workers."""
+    # counts of the supervisor (catalog warm-up) are not the worker's
+    metrics.registry.reset()
+    metrics.registry.const_labels = (('worker', str(worker)),)
+    if args.cache_db:
+        apiaccess.configure_parse_cache(args.cache_db)
+        apiaccess.configure_interview_cache(args.cache_db)
+    if args.record:
+        apiaccess.record_traffic('{}.{}'.format(args.record, os.getpid()))
+    store = sessionstore.SessionStore(0, session_db)
+    manager = server.SessionManager(auth_string, args.model,
+                                    args.prefetch_triage,
+                                    not args.group_questions, store)
+    httpd = server.make_server(args.host, args.port, manager, sock)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        store.close()
+        apiaccess.stop_recording()
+
+
+def supervise(workers, start_worker):
+    """Forks the workers, each running start_worker(number), and restarts
+    the ones that die (under the same number) until SIGTERM or SIGINT is
+    received."""
+    children = {}  # pid -> (start time, worker number)
+    stopping = False
+
+    def spawn(worker):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            code = 0
+            try:
+                start_worker(worker)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic(), worker
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker in range(workers):
+        spawn(worker)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        child = children.pop(pid, None)
+        if child is None or stopping:
+            continue
+        started, worker = child
+        print('worker {} exited with status {}, restarting'.format(
+            pid, os.waitstatus_to_exitcode(status)), file=sys.stderr)
+        if time.monotonic() - started < constants.SUPERVISOR_RESTART_DELAY:
+            time.sleep(constants.SUPERVISOR_RESTART_DELAY)
+        spawn(worker)
+
+
+def parse_args():
+    parser = server.make_parser()
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="number of worker processes (one per core by "
+                             "default)")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    # opened by each worker (see serve)
+    record, args.record = args.record, None
+    cache_db, args.cache_db = args.cache_db, None
+    auth_string = server.setup(args)
+    args.record, args.cache_db = record, cache_db
+    # the workers share the API quota
+    ratelimit.configure(**ratelimit.divide_limits(
+        ratelimit.parse_limits(args.rate_limit), args.workers))
+    temporary_dir = None
+    if args.catalog_dir is None or args.session_db is None:
+        temporary_dir = tempfile.mkdtemp(prefix='supervisor-')
+    if args.catalog_dir is None:
+        catalog.configure(snapshot_dir=temporary_dir)
+    session_db = args.session_db
+    if session_db is None:
+        session_db = os.path.join(temporary_dir, 'sessions.sqlite')
+    # creates the tables before the workers open the file
+    sessionstore.SessionStore(0, session_db).close()
+    warm_catalogs(auth_string, args.model)
+    sock = listen(args.host, args.port)
+    print('serving on {}:{} with {} workers'.format(
+        args.host, args.port, args.workers), file=sys.stderr)
+    try:
+        supervise(args.workers,
+                  lambda worker: serve(sock, args, auth_string, session_db,
+                                       worker))
+    finally:
+        sock.close()
+        if temporary_dir is not None:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,183 @@
+"""Recording and replaying of API traffic.
+
+A TrafficRecorder appends every call made by apiaccess.call_endpoint (request,
+response and timings, credentials redacted) to a JSON lines log, writing on a
+background thread and rotating the file when it grows too big. A
+TrafficReplayer answers calls from such logs instead of the network, which
+gives deterministic, offline reproductions of recorded sessions. The same
+logs can be served by mockserver.py.
+"""
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+import constants
+import responsecache
+
+
+REDACTED_HEADERS = ('App-Id', 'App-Key')
+
+
+class ReplayMissError(IOError):
+    pass
+
+
+def request_key(endpoint, params, body):
+    """Returns the key under which a request is looked up in recorded
+    traffic (the same for equivalent requests). Query parameters are
+    compared as strings, the way they are sent."""
+    params = {name: str(value) for name, value in (params or {}).items()}
+    return responsecache.make_key(endpoint, params, body)
+
+
+def load_recordings(path):
+    """Reads recorded traffic: JSON lines, each with "endpoint", "request"
+    (request body, if any), "params" (query parameters, if any) and
+    "response" fields.
+
+    Returns:
+        dict: Responses keyed by request_key.
+
+    """
+    recordings = {}
+    with open(path, encoding='utf-8') as stream:
+        for line in stream:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'response' not in record:
+                continue
+            key = request_key(record['endpoint'], record.get('params'),
+                              record.get('request'))
+            recordings[key] = record['response']
+    return recordings
+
+
+def redact(headers):
+    """Returns a copy of the headers with credentials masked."""
+    return {name: '***' if name in REDACTED_HEADERS else value
+            for name, value in headers.items()}
+
+
+class TrafficRecorder:
+    """Appends records to a rotating JSON lines log on a background thread.
+
+    Args:
+        path (str): Log file.
+        max_bytes (int): Size after which the log is rotated (to path.1,
+            path.2 and so on).
+        backup_count (int): Number of rotated logs to keep.
+
+    """
+
+    def __init__(self, path, max_bytes=constants.TRAFFIC_LOG_MAX_BYTES,
+                 backup_count=constants.TRAFFIC_LOG_BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_records,
+                                        name='traffic-recorder', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, endpoint, method, params, request_body, headers,
+               status, response_body, timing):
+        """Queues one call for writing. Bodies are taken as sent and
+        received, and decoded on the writer thread.
+
+        Args:
+            endpoint (str): Endpoint name.
+            method (str): HTTP method.
+            params (dict): Query parameters.
+            request_body (bytes): Request body (None for GET).
+            headers (dict): Request headers (redacted here).
+            status (int): HTTP status.
+            response_body (bytes): Response body.
+            timing (dict): Durations in milliseconds and sizes in bytes.
+
+        """
+        self._queue.put((time.time(), endpoint, method, params, request_body,
+                         redact(headers), status, response_body, timing))
+
+    def close(self):
+        """Writes out everything queued and stops the writer."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _write_records(self):
+        stream = open(self.path, 'a', encoding='utf-8')
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                record = self._decode(item)
+                stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+                if stream.tell() >= self.max_bytes:
+                    stream.close()
+                    self._rotate()
+                    stream = open(self.path, 'a', encoding='utf-8')
+                elif self._queue.empty():
+                    stream.flush()
+        finally:
+            stream.close()
+
+    @staticmethod
+    def _decode(item):
+        (ts, endpoint, method, params, request_body, headers, status,
+         response_body, timing) = item
+        return {
+            'ts': ts,
+            'endpoint': endpoint,
+            'method': method,
+            'params': params,
+            'request': json.loads(request_body) if request_body else None,
+            'headers': headers,
+            'status': status,
+            'response': json.loads(response_body),
+            'timing': timing}
+
+    def _rotate(self):
+        for idx in range(self.backup_count - 1, 0, -1):
+            older = '{}.{}'.format(self.path, idx)
+            if os.path.exists(older):
+                os.replace(older, '{}.{}'.format(self.path, idx + 1))
+        if self.backup_count:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+
+class TrafficReplayer:
+    """Serves responses from recorded traffic.
+
+    Args:
+        paths (list): Logs written by TrafficRecorder (or in the same
+            format); later ones take precedence.
+
+    """
+
+    def __init__(self, paths):
+        self.recordings = {}
+        for path in paths:
+            self.recordings.update(load_recordings(path))
+
+    def response(self, endpoint, params, request):
+        """Returns the recorded response to the request.
+
+        Raises:
+            ReplayMissError: If the request wasn't recorded.
+
+        """
+        try:
+            response = self.recordings[request_key(endpoint, params, request)]
+        except KeyError:
+            raise ReplayMissError('no recorded response for this /{} '
+                                  'request'.format(endpoint))
+        # Callers may modify what they get, don't let that affect replays.
+        return json.loads(json.dumps(response))